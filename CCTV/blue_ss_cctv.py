@@ -18,6 +18,7 @@ Purpose:
     -This is a POC script to test out the functionality of pyBlueIris to see how we can control a BlueIris CCTV Server
     -It could also be manually run from the cli for any ad-hoc commands/control that may be needed
     -This script was initially be used as a module in a larger security system program suite in order to interact with BlueIris based on events/alrms from that security system
+    -It can run as a long lived control daemon ('-d') that keeps one logged in, keep-alive session to BlueIris and takes commands over a local socket. When the daemon is running, '-c' just hands the command to it
 
 Considerations:
     -This is just a POC script that is being tested on a BlueIris 4 Server Install on Windows 10
@@ -29,6 +30,18 @@ Arguments:
     --The process for invoking this script: 'python blue_ss.py -hn <host> -p <protocol> -u <user> -t <token> -c <command> -a <command args>'
         -This would be: 'python3 blue_ss.py -hn 192.168.1.2 -p http -u admin -t password123 -c list_cameras
         -Note that some commands may take additional arguments to get the expected result! Refer to the README in order to determine when to use these 
+    --To start the daemon: 'python3 blue_ss_cctv.py -d -hn 192.168.1.2 -p http -u admin -t password123'
+        -Then commands only need: 'python3 blue_ss_cctv.py -c set_status -a profile=away'
+        -'--local' runs the command in this process even if a daemon is running
+    --Camera commands can take a list of cameras or every camera, which run at the same time (at most '-l' at once): '-c pause_camera_indef -a camera=cam1;cam2' or '-a camera=all'
+    --A whole script of commands can run on one session: 'python3 blue_ss_cctv.py -b arm.txt' (or '-b -' for stdin)
+        -One command per line, either 'pause_camera_indef camera=cam1;cam2' or a JSON line '{"command": "set_status", "arguments": "profile=away"}'
+        -Commands run at the same time unless one changes a camera (or the whole server) that an earlier one uses - then it waits. A 'wait' line makes everything after it wait
+        -Each result is printed as a JSON line (with its script line number) followed by a summary line
+    --Every BlueIris call times out after '--timeout' seconds (default 10) and is tried again up to '--retries' times (default 2)
+        -After 5 failed calls in a row commands fail straight away for 30 seconds, then one is let through to see if BlueIris is back
+        -'-c metrics' shows latency percentiles and error rates per command
+    --The daemon keeps the camera list and camera details for '--ttl' seconds (default 60, 0 turns it off). Pausing, unpausing or changing the status clears it. '-c cache_stats' shows how often it was used
 
 To Do:
     -Create requirements file using pipreqs - https://blog.jcharistech.com/2020/11/02/how-to-create-requirements-txt-file-in-python/
@@ -40,12 +53,27 @@ To Do:
 
 ### IMPORT LIBRARIES ###
 import logging      #https://docs.python.org/3.8/library/logging.html - Used to log errors and other script information
-import pyblueiris   #https://pypi.org/project/pyblueiris/ - Used to interface with BlueIris
-from aiohttp import ClientSession   #https://docs.python.org/3.8/library/aiohttp.html - This is for making the connection to the BlueIris server (in this script's case, localhost)
 import argparse     #https://docs.python.org/3.8/library/argparse.html - Used for parsing through arguments handed to the script
+import asyncio      #https://docs.python.org/3.8/library/asyncio.html - Used for running the control daemon and talking to BlueIris
+import json     #https://docs.python.org/3.8/library/json.html - Used for the requests and replies on the daemon socket
+import socket   #https://docs.python.org/3.8/library/socket.html - Used by the thin client to hand commands to the daemon
+import os       #https://docs.python.org/3.8/library/os.html - Used for cleaning up the daemon socket
+import time     #https://docs.python.org/3.8/library/time.html - Used for timing each camera in a multi-camera command
+import sys      #https://docs.python.org/3.8/library/sys.html - Used for reading a command script from stdin
+import random   #https://docs.python.org/3.8/library/random.html - Used for the jitter between retries
+from collections import deque   #https://docs.python.org/3.8/library/collections.html - Used for the rolling window of latencies per command
+#pyblueiris (https://pypi.org/project/pyblueiris/) and aiohttp (https://docs.aiohttp.org/) are imported in ssblue_iris.connect - the thin client never needs them
 
 
 ### DEFINE VARIABLES ###
+socket_path = "/tmp/blue_ss_cctv.sock"  #Unix socket the control daemon listens on
+daemon_port = 8766                      #Local port the daemon listens on instead where there are no Unix sockets (Windows)
+command_table = {}                      #Every command ssblue_iris knows - name: (handler, scope, changes). Filled in by @register
+retry_backoff = 0.25                    #Seconds before the first retry of a failed BlueIris call - doubled each retry, with jitter
+retry_backoff_max = 2                   #Most seconds to wait between retries
+breaker_failures = 5                    #Failed BlueIris calls in a row before we stop trying and fail fast
+breaker_cooldown = 30                   #Seconds to fail fast before one call is let through to see if BlueIris is back
+metrics_window = 200                    #Latest calls per command kept for the latency percentiles and error rate
 
 #Set up logging for user activities
 logging_file = "blue_ss.log"         #Define log file location for windows
@@ -59,6 +87,112 @@ fh.setFormatter(formatter)                  #Add the format to the file handler
 
 
 ### CLASSES AND FUNCTIONS ###
+#Function to turn command arguments ('camera=<camera name>, seconds=<seconds>') into a dict
+def parse_arguments(args):
+    params = {}
+    for pair in (args or "").split(","):
+        if "=" in pair:
+            key, value = pair.split("=", 1)
+            params[key.strip()] = value.strip()
+    return params
+
+#Function to add a command handler to the command table
+def register(name, scope="camera", changes=False):
+    """
+        :param name:        Name of the command as it is given with '-c' (required)
+        :param scope:       What the command works on - "camera" (the 'camera' argument, which can also be a list of cameras or 'all'), "server" (every camera) or "none"
+        :param changes:     True if the command changes something on BlueIris, so commands on the same cameras in a script have to wait for it
+
+        Example:    @register("unpause_camera", changes=True)
+    """
+    def add(handler):
+        command_table[name] = (handler, scope, changes)
+        return handler
+    return add
+
+#Class for a "fail" reply from BlueIris (an expired session, a refused login or a request it would not do). pyblueiris hands these back as False or as the reply data, so we raise this instead
+class blueiris_error(Exception):
+    pass
+
+#Class to stop calling BlueIris while it is down. After enough failures in a row calls fail fast, and after the cooldown one probe call is let through - if it works we close again
+class circuit_breaker:
+    """
+        :param failures:    Failed calls in a row before the breaker opens
+        :param cooldown:    Seconds to stay open before letting a probe call through
+
+        Example:    breaker = circuit_breaker(5, 30)
+    """
+    def __init__(self, failures=breaker_failures, cooldown=breaker_cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failed = 0         #Failed calls in a row
+        self.opened = 0         #When the breaker last opened
+        self.trips = 0
+
+    #Function to check if a call may go through. Only one probe goes through per cooldown while half open
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if time.monotonic() - self.opened >= self.cooldown:
+            self.state = "half_open"
+            self.opened = time.monotonic()
+            logger.info("Circuit breaker half open, probing BlueIris")
+            return True
+        return False
+
+    def success(self):
+        if self.state != "closed":
+            logger.info("BlueIris answered the probe, circuit breaker closed")
+        self.state = "closed"
+        self.failed = 0
+
+    def failure(self):
+        self.failed += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failed >= self.failures):
+            self.state = "open"
+            self.opened = time.monotonic()
+            self.trips += 1
+            logger.error("BlueIris is not answering, circuit breaker open for %s seconds", self.cooldown)
+
+    #Function to get the seconds left before the next probe
+    def retry_in(self):
+        return max(0.0, round(self.cooldown - (time.monotonic() - self.opened), 1)) if self.state != "closed" else 0.0
+
+    def stats(self):
+        return {"state": self.state, "failed_in_a_row": self.failed, "trips": self.trips, "retry_in": self.retry_in()}
+
+#Class to keep the latest latencies and outcomes of each command for percentiles and error rates
+class command_metrics:
+    """
+        :param window:      Latest calls kept per command
+
+        Example:    metrics = command_metrics(200)
+    """
+    def __init__(self, window=metrics_window):
+        self.window = window
+        self.calls = {}         #command: deque of (latency ms, ok)
+        self.totals = {}        #command: [calls, errors] since start
+
+    def record(self, command, latency_ms, ok):
+        if command not in self.calls:
+            self.calls[command] = deque(maxlen=self.window)
+            self.totals[command] = [0, 0]
+        self.calls[command].append((latency_ms, ok))
+        self.totals[command][0] += 1
+        if not ok:
+            self.totals[command][1] += 1
+
+    #Function to get the percentiles and error rate of every command over the window
+    def summary(self):
+        summary = {}
+        for (command, calls) in self.calls.items():
+            latencies = sorted(latency for (latency, ok) in calls)
+            errors = sum(1 for (latency, ok) in calls if not ok)
+            percentile = lambda share: latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+            summary[command] = {"window": len(calls), "p50_ms": percentile(0.5), "p90_ms": percentile(0.9), "p99_ms": percentile(0.99), "max_ms": latencies[-1], "error_rate": round(errors / len(calls), 3), "calls": self.totals[command][0], "errors": self.totals[command][1]}
+        return summary
+
 class ssblue_iris:
     """
         :param host:        IP or FQDN of the BlueIris server to be controlled (required)
@@ -67,26 +201,156 @@ class ssblue_iris:
         :param protocol:    The connection protocol (either HTTP or HTTPS) (required)
         :param command:     The command to run on the CCTV host (required)
         :param arguments:   Arguments for the given command if needed
+        :param limit:       Most BlueIris requests in flight at once for multi-camera commands
+        :param ttl:         Seconds to keep the camera list and camera details before asking BlueIris again (0 to always ask)
+        :param timeout:     Seconds to wait for each BlueIris call before giving up on it
+        :param retries:     Times a failed BlueIris call is tried again. The worst case for one call is about (retries + 1) * timeout + retries * retry_backoff_max
 
         Example:    python3 blue_ss.py -hn 192.168.1.2 -p http -u admin -t password123 -c list_cameras    
     """
+    def __init__(self, BI_HOST, BI_USER, BI_PASS, PROTOCOL, limit=8, ttl=60, timeout=10, retries=2):
+        self.limit = max(1, limit)
+
+        #Resilience - every BlueIris call gets a timeout and a few retries, and the breaker fails fast while the server is down
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.breaker = circuit_breaker()
+        self.metrics = command_metrics()
+        self.retried = 0
+        self.timeouts = 0
+
+        #Camera state cache - key: (expires, value). Our own pause/unpause/set_status commands clear it
+        self.ttl = ttl
+        self.cache = {}
+        self.loading = {}       #Keys being fetched right now - key: (task, generation), so callers that miss together share one request
+        self.generation = 0     #Bumped on every invalidation so a fetch that started before it is not cached
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self.host = BI_HOST
+        self.user = BI_USER
+        self.password = BI_PASS
+        self.protocol = PROTOCOL
+        self.session = None
+        self.bi_server = None
+        self.login_lock = None
+        self.logins = 0     #Times we have logged in, so a burst of failed calls only logs back in once
+
+    #Open one pooled, keep-alive session to the server and log in. The session is kept for as long as we run
+    async def connect(self):
+        global pyblueiris, aiohttp
+        import pyblueiris   #https://pypi.org/project/pyblueiris/ - Used to interface with BlueIris
+        import aiohttp      #https://docs.aiohttp.org/ - This is for making the connection to the BlueIris server (in this script's case, localhost)
 
-    #Open the session to the server
-    async def __init__(self, BI_HOST, BI_USER, BI_PASS, PROTOCOL):
         try:
-            async with ClientSession(raise_for_status=True) as self.session:
-                self.bi_server = pyblueiris.BlueIris(self.session, BI_USER, BI_PASS, PROTOCOL, BI_HOST)
-                logger.info("Connected to the host server!")
+            self.login_lock = asyncio.Lock()
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=300)
+            self.session = aiohttp.ClientSession(connector=connector, raise_for_status=True, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.bi_server = pyblueiris.BlueIris(self.session, self.user, self.password, self.protocol, self.host)
+            await self.login(0)
+            logger.info("Connected to the host server!")
         except:
             logger.critical("Unable to connect to host server!")
-
-    #If the script/class quits, close the connection cleanly
-    def __del__(self):
-        self.session.close()
-        logger.info("Closed session to the host server")
-
-    #Execute the command that the user/server requested
-    def execute(self, command, args):
+            raise
+
+    #Log in to BlueIris (again). Calls that failed together wait on the one login instead of each logging in
+    async def login(self, seen_logins):
+        async with self.login_lock:
+            if self.logins == seen_logins:
+                if not await asyncio.wait_for(self.bi_server.setup_session(), self.timeout):
+                    raise blueiris_error("BlueIris refused the login for %s" % self.user)
+
+                #setup_session takes any reply with data in it as a good login (refused ones can have a reason in there), so make sure the session works
+                try:
+                    await asyncio.wait_for(self.send("status"), self.timeout)
+                except blueiris_error:
+                    raise blueiris_error("BlueIris refused the login for %s" % self.user)
+                self.logins += 1
+                logger.info("Logged in to the host server")
+
+    #Run a call against BlueIris with a timeout. Connection errors and timeouts are retried (with jittered backoff) up to self.retries times and count towards the circuit breaker. A "fail" reply logs back in first (BlueIris sessions expire). Anything else is a problem with the request, so it goes straight back to the caller. Calls that are not idempotent (like adding time to a pause) are only sent again if they never reached BlueIris
+    async def call(self, function, *args, idempotent=True):
+        if not self.breaker.allow():
+            raise RuntimeError("BlueIris is not answering, trying again in %s seconds" % self.breaker.retry_in())
+
+        #Remember if this call is the half open probe, so however it ends the breaker does not stay half open
+        probe = self.breaker.state == "half_open"
+        try:
+            for attempt in range(self.retries + 1):
+                seen_logins = self.logins
+                try:
+                    result = await asyncio.wait_for(function(*args), self.timeout)
+                    self.breaker.success()
+                    return result
+                except (aiohttp.ClientError, asyncio.TimeoutError, blueiris_error) as error:
+                    refused = isinstance(error, blueiris_error)
+                    if refused:
+                        #BlueIris answered (it only turned the session down), so it is up
+                        self.breaker.success()
+                    #Only a refused call or one that could not connect is sure not to have been applied (pyblueiris wraps aiohttp's error, so check the one it wrapped)
+                    sent = not refused and not isinstance(error.__context__ or error, aiohttp.ClientConnectorError)
+                    if isinstance(error, asyncio.TimeoutError):
+                        self.timeouts += 1
+                        error = "timed out after %s seconds" % self.timeout
+                    if attempt == self.retries or (sent and not idempotent):
+                        if not refused:
+                            self.breaker.failure()
+                        if attempt < self.retries:
+                            raise RuntimeError("BlueIris call failed and was not tried again as it may have gone through: %s" % error)
+                        raise RuntimeError("BlueIris call failed after %s tries: %s" % (attempt + 1, error))
+
+                    self.retried += 1
+                    if refused:
+                        #A refused login is not going to get better by trying again, so that goes back to the caller
+                        logger.info("BlueIris refused the call (%s), logging back in and trying again", error)
+                        try:
+                            await self.login(seen_logins)
+                        except (aiohttp.ClientError, asyncio.TimeoutError) as login_error:
+                            logger.error("Unable to log back in to the host server: %s", login_error)
+                    else:
+                        delay = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+                        logger.info("BlueIris call failed (%s), trying again in %.2f seconds", error, delay)
+                        await asyncio.sleep(delay)
+                except Exception:
+                    #Anything else came back from BlueIris (or never left us), so it says nothing about BlueIris being down
+                    self.breaker.success()
+                    raise
+        finally:
+            #A probe that was cancelled part way opens the breaker again, so the next probe waits out a fresh cooldown
+            if probe and self.breaker.state == "half_open":
+                self.breaker.failure()
+
+    #Function to send one command to BlueIris and hand back the data in its reply. A "fail" reply marks the session as logged out and raises, so call logs back in and tries again
+    async def send(self, command, params=None):
+        reply = await self.bi_server.client.cmd(command, params)
+        if reply.get("result") != "success":
+            self.bi_server.am_logged_in = False
+            reason = reply["data"].get("reason") if isinstance(reply.get("data"), dict) else None
+            raise blueiris_error("BlueIris refused %s: %s" % (command, reason or reply.get("result")))
+        return reply.get("data", True)
+
+    #Function to make sure a camera exists before we change it, so a typo is an error instead of a command BlueIris ignores
+    async def check_camera(self, camera):
+        if camera not in await self.camera_list():
+            #It may have been added since we last listed the cameras
+            self.cache.pop(("cameras",), None)
+            if camera not in await self.camera_list():
+                raise ValueError("unknown camera: %s" % camera)
+
+    #Function to pause (or unpause) a camera with a camconfig command. Value is one of pyblueiris' CAMConfig pause values
+    async def pause(self, camera, value, idempotent=True):
+        await self.check_camera(camera)
+        await self.call(self.send, "camconfig", {"camera": camera, "pause": value}, idempotent=idempotent)
+
+    #Close the session to the server cleanly
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("Closed session to the host server")
+
+    #Execute the command that the user/server requested and return the result as a dict for the caller
+    async def execute(self, command, args):
         """
         Required possible commands - 
 
@@ -96,63 +360,432 @@ class ssblue_iris:
         :pause_camera_indef:    Indefinitely pause a given camera (needs arguments passed)
         :unpause_camera:        Unpause a given camera (needs arguments passed)
         :set_status:            Set the profile status on BlueIris by using profile name (needs arguments passed)
+        :cache_stats:           Hit/miss counts for the camera state cache. Does not take additional arguments
+        :metrics:               Latency percentiles and error rates per command, retries, timeouts and the circuit breaker state. Does not take additional arguments
 
         """
-        #Determine the command that we received and run it
-        #List all cameras and send it to the alert users on file
-        if command == "list_cameras":
-            self.send_alert(self.bi_server.cameras)
-
-        #Requires command args to be '-a camera=<camera name>'
-        if command == "camera_details":
+        params = parse_arguments(args)
+        if command not in command_table:
+            logger.error("Invalid command given! %s", command)
+            return {"ok": False, "command": command, "error": "invalid command"}
+        (handler, scope, changes) = command_table[command]
+
+        #Several cameras at once get fanned out
+        camera = params.get("camera", "")
+        if scope == "camera" and (camera.lower() == "all" or ";" in camera):
+            return await self.fan_out(command, params)
+
+        started = time.perf_counter()
+        reply = await handler(self, command, params, args)
+        if scope != "none":
+            self.metrics.record(command, round((time.perf_counter() - started) * 1000, 1), reply.get("ok"))
+        return reply
+
+    #List all cameras and send it to the alert users on file
+    @register("list_cameras", scope="server")
+    async def list_cameras(self, command, params, args):
+        try:
+            cameras = await self.cached(("cameras",), self.load_cameras)
+            self.send_alert(cameras)
+            return {"ok": True, "command": command, "result": cameras}
+        except Exception as error:
+            logger.error("Unable to list cameras")
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #Requires command args to be '-a camera=<camera name>'
+    @register("camera_details")
+    async def camera_details(self, command, params, args):
+        try:
+            details = await self.cached(("details", params["camera"]), lambda: self.load_details(params["camera"]))
+            self.send_alert(details)
+            logger.info("Sent camera details!")
+            return {"ok": True, "command": command, "result": details}
+        except Exception as error:
+            logger.error("Unable to gather information for requested camera: %s", args)
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #Requires command args to be '-a camera=<camera name>, seconds=<seconds to pause camera>'
+    @register("pause_camera_time", changes=True)
+    async def pause_camera_time(self, command, params, args):
+        try:
             try:
-                self.send_alert(self.bi_server.get_camera_details(args))
-                logger.info("Sent camera details!")
-            except:
-                logger.error("Unable to gather information for requested camera: %s", args)
-
-        #Requires command args to be '-a camera=<camera name>, seconds=<seconds to pause camera>'
-        if command == "pause_camera_time":
+                #BlueIris only pauses in steps of an hour, a minute and 30 seconds, so add up the steps (rounded down to 30 seconds). Each step adds to the pause, so a step that may have gone through is never sent again
+                seconds = max(30, int(params["seconds"]))
+                steps = [(seconds // 3600, pyblueiris.const.CAMConfig.PAUSE_ADD_1_HOUR), (seconds % 3600 // 60, pyblueiris.const.CAMConfig.PAUSE_ADD_1_MIN), (seconds % 60 // 30, pyblueiris.const.CAMConfig.PAUSE_ADD_30_SEC)]
+                for (count, step) in steps:
+                    for repeat in range(count):
+                        await self.pause(params["camera"], step.value, idempotent=False)
+            finally:
+                self.invalidate(params.get("camera"))
+            logger.info("Paused camera with following params: %s", args)
+            self.send_alert("Pased camera with following params: ", args)
+            return {"ok": True, "command": command, "result": args}
+        except Exception as error:
+            logger.error("Unable to pause camera: %s", args)
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #Requires command args to be '-a camera=<camera name>'
+    @register("pause_camera_indef", changes=True)
+    async def pause_camera_indef(self, command, params, args):
+        try:
             try:
-                self.bi_server.pause_camera(args)
-                logger.info("Paused camera with following params: %s", args)
-                self.send_alert("Pased camera with following params: ", args)
-            except:
-                logger.error("Unable to pause camera: %s", args)
-
-        #Requires command args to be '-a camera=<camera name>'
-        if command == "pause_camera_indef":
+                await self.pause(params["camera"], pyblueiris.const.CAMConfig.PAUSE_INDEFINITELY.value)
+            finally:
+                self.invalidate(params.get("camera"))
+            logger.info("Paused camera indefinitely: %s", args)
+            self.send_alert("Indefinitely paused camera: ", args)
+            return {"ok": True, "command": command, "result": args}
+        except Exception as error:
+            logger.error("Unable to indefinitely pause camera: %s", args)
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #Requires command args to be '-a camera=<camera name>'
+    @register("unpause_camera", changes=True)
+    async def unpause_camera(self, command, params, args):
+        try:
             try:
-                self.bi_server.pause_camera_indefinitely(args)
-                logger.info("Paused camera indefinitely: %s", args)
-                self.send_alert("Indefinitely paused camera: ", args)
-            except:
-                logger.error("Unable to indefinitely pause camera: %s", args)
-        
-        #Requires command args to be '-a camera=<camera name>'
-        if command == "unpause_camera":
+                await self.pause(params["camera"], pyblueiris.const.CAMConfig.PAUSE_CANCEL.value)
+            finally:
+                self.invalidate(params.get("camera"))
+            logger.info("Unpaused camera: %s", args)
+            self.send_alert("Unpaused camera: ", args)
+            return {"ok": True, "command": command, "result": args}
+        except Exception as error:
+            logger.error("Unable to unpause camera: %s", args)
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #Requires command args to be '-a profile=<profile name>'
+    @register("set_status", scope="server", changes=True)
+    async def set_status(self, command, params, args):
+        try:
             try:
-                self.bi_server.unpause_camera(args)
-                logger.info("Unpaused camera: %s", args)
-                self.send_alert("Unpaused camera: ", args)
-            except:
-                logger.error("Unable to unpause camera: %s", args)
-
-        #Requires command args to be '-a profile_index=<profile name>'
-        if command == "set_status":
+                profile = params.get("profile", params.get("profile_index"))
+                profiles = self.bi_server.attributes.get("profiles") or []
+                if profile not in profiles:
+                    raise ValueError("unknown profile: %s (BlueIris has %s)" % (profile, ", ".join(str(name) for name in profiles)))
+                await self.call(self.send, "status", {"profile": profiles.index(profile)})
+            finally:
+                self.invalidate()
+            logger.info("Set profile status to: %s", args)
+            self.send_alert("Set camera profile to: ", args)
+            return {"ok": True, "command": command, "result": args}
+        except Exception as error:
+            logger.error("Unable to set profile to: %s", args)
+            return {"ok": False, "command": command, "error": str(error)}
+
+    #How well the camera state cache is doing
+    @register("cache_stats", scope="none")
+    async def cache_stats_command(self, command, params, args):
+        return {"ok": True, "command": command, "result": self.cache_stats()}
+
+    #Latency and error rate of each command, and how the resilience layer is doing
+    @register("metrics", scope="none")
+    async def metrics_command(self, command, params, args):
+        return {"ok": True, "command": command, "result": {"commands": self.metrics.summary(), "retries": self.retried, "timeouts": self.timeouts, "breaker": self.breaker.stats()}}
+
+    #Function to get a value from the camera state cache, fetching it from BlueIris if it is missing or older than the TTL
+    async def cached(self, key, loader):
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if key not in self.loading:
+            task = asyncio.ensure_future(loader())
+            task.add_done_callback(lambda done: self.loading.pop(key, None))
+            self.loading[key] = (task, self.generation)
+        (task, generation) = self.loading[key]
+
+        value = await task
+        if self.ttl > 0 and generation == self.generation:
+            self.cache[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    #Function to throw away cached state after we change something - one camera (and the camera list, which shows if it is paused), or everything
+    def invalidate(self, camera=None):
+        self.generation += 1
+        self.invalidations += 1
+        if camera is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(("details", camera), None)
+            self.cache.pop(("cameras",), None)
+
+    #Function to report how the camera state cache is doing
+    def cache_stats(self):
+        lookups = self.hits + self.misses
+        return {"ttl": self.ttl, "entries": len(self.cache), "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0, "invalidations": self.invalidations}
+
+    #Function to fetch the camera list from BlueIris as plain data ([{"camera": <short name>, "name": <display name>}], groups left out) so it can be cached and sent back as JSON
+    async def load_cameras(self):
+        camlist = await self.call(self.send, "camlist")
+        return [{"camera": camera["optionValue"], "name": camera.get("optionDisplay")} for camera in camlist if "group" not in camera]
+
+    #Function to fetch the full camconfig BlueIris has for one camera
+    async def load_details(self, camera):
+        for details in await self.call(self.send, "camlist"):
+            if details.get("optionValue") == camera:
+                return details
+        raise ValueError("unknown camera: %s" % camera)
+
+    #Function to get the short name of every camera on the server
+    async def camera_list(self):
+        return [camera["camera"] for camera in await self.cached(("cameras",), self.load_cameras)]
+
+    #Function to run a camera command against a list of cameras (or all of them) concurrently, with at most self.limit requests in flight. Returns a result table with each camera's latency
+    async def fan_out(self, command, params):
+        started = time.perf_counter()
+        if params["camera"].lower() == "all":
             try:
-                self.bi_server.set_status_profile_by_name(args)
-                logger.info("Set profile status to: %s", args)
-                self.send_alert("Set camera profile to: ", args)
-            except:
-                logger.error("Unable to set profile to: %s", args)
-
+                cameras = await self.camera_list()
+            except Exception as error:
+                logger.error("Unable to list cameras for %s", command)
+                return {"ok": False, "command": command, "error": str(error)}
         else:
-            logger.error("Invalid command given! %s", command)
+            cameras = [camera.strip() for camera in params["camera"].split(";") if camera.strip()]
+
+        semaphore = asyncio.Semaphore(self.limit)
+
+        #Each camera goes through the normal single camera command
+        async def run_camera(camera):
+            async with semaphore:
+                camera_started = time.perf_counter()
+                reply = await self.execute(command, ", ".join(f"{key}={value}" for (key, value) in dict(params, camera=camera).items()))
+                return dict(reply, camera=camera, latency_ms=round((time.perf_counter() - camera_started) * 1000, 1))
+
+        table = await asyncio.gather(*[run_camera(camera) for camera in cameras])
+        failed = [row["camera"] for row in table if not row.get("ok")]
+        logger.info("Ran %s on %s cameras in %.0f ms (%s failed)", command, len(cameras), (time.perf_counter() - started) * 1000, len(failed))
+
+        return {"ok": not failed, "command": command, "cameras": table, "failed": failed, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
 
     #Send alerts if needed based on the action that was done so the user gets a confirmation or a notification of what happened
-    def send_alert(msg_data):
-        print("SEND ALERTS NOT YET IMPLIMENTED")
+    def send_alert(self, *msg_data):
+        logger.debug("SEND ALERTS NOT YET IMPLIMENTED")
+
+#Function to read a command script - one command per line, either '<command> <args>' or a JSON line ({"command": <command>, "arguments": <args>}). Blank lines and '#' comments are skipped, and a 'wait' line makes everything after it wait for everything before it
+def parse_script(lines):
+    steps = []
+    wait = False
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line == "wait":
+            wait = True
+            continue
+
+        try:
+            if line.startswith("{"):
+                request = json.loads(line)
+                step = {"line": number, "command": request["command"], "arguments": request.get("arguments"), "wait": wait or bool(request.get("wait"))}
+            else:
+                parts = line.split(None, 1)
+                step = {"line": number, "command": parts[0], "arguments": parts[1] if len(parts) > 1 else None, "wait": wait}
+        except Exception as error:
+            logger.error("Unable to read line %s of the command script", number)
+            step = {"line": number, "command": None, "arguments": None, "wait": wait, "error": str(error)}
+
+        steps.append(step)
+        wait = False
+    return steps
+
+#Function to get the cameras a script step works on ("*" is every camera, nothing for commands that do not touch BlueIris)
+def step_targets(step):
+    if step["command"] not in command_table:
+        return set()
+    scope = command_table[step["command"]][1]
+    if scope == "none":
+        return set()
+    if scope == "server":
+        return {"*"}
+
+    camera = parse_arguments(step["arguments"]).get("camera", "")
+    if camera.lower() == "all":
+        return {"*"}
+    return {camera.strip() for camera in camera.split(";") if camera.strip()}
+
+#Function to check if a script step has to wait for an earlier one - they work on the same cameras and at least one of them changes something
+def step_depends(earlier, step):
+    changes = any(command_table[item["command"]][2] for item in (earlier, step) if item["command"] in command_table)
+    (before, after) = (step_targets(earlier), step_targets(step))
+    if not changes or not before or not after:
+        return False
+    return "*" in before or "*" in after or bool(before & after)
+
+#Function to run a command script on one session. Steps start as soon as the earlier steps they depend on are done, results are handed to emit in script order, and a summary is returned at the end
+async def run_script(server, lines, emit):
+    started = time.perf_counter()
+    steps = parse_script(lines)
+    tasks = []
+    fence = 0       #Steps before the last 'wait' - everything after it waits for all of them
+
+    #Each step waits for what it depends on, then goes through the normal command path
+    async def run_step(step, after):
+        await asyncio.gather(*after)
+        if "error" in step:
+            return {"ok": False, "command": step["command"], "error": step["error"], "line": step["line"], "latency_ms": 0.0}
+
+        step_started = time.perf_counter()
+        try:
+            reply = await server.execute(step["command"], step["arguments"])
+        except Exception as error:
+            logger.error("Script line %s failed: %s", step["line"], step["command"])
+            reply = {"ok": False, "command": step["command"], "error": str(error)}
+        return dict(reply, line=step["line"], latency_ms=round((time.perf_counter() - step_started) * 1000, 1))
+
+    for (index, step) in enumerate(steps):
+        if step["wait"]:
+            fence = index
+        after = tasks[:fence] + [tasks[earlier] for earlier in range(fence, index) if step_depends(steps[earlier], step)]
+        tasks.append(asyncio.ensure_future(run_step(step, after)))
+
+    failed = []
+    for task in tasks:
+        reply = await task
+        if not reply.get("ok"):
+            failed.append(reply["line"])
+        emit(reply)
+
+    logger.info("Ran a script of %s commands in %.0f ms (%s failed)", len(steps), (time.perf_counter() - started) * 1000, len(failed))
+    return {"ok": not failed, "command": "script", "steps": len(steps), "failed": failed, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+#Class to run the long lived control daemon. It keeps one logged in BlueIris session and takes commands (one JSON line each) over a local socket, so a command only costs a round trip to BlueIris
+class cctv_daemon:
+    """
+        :param server:      The ssblue_iris client to run commands with (required)
+        :param path:        Unix socket to listen on
+        :param port:        Local port to listen on where there are no Unix sockets
+
+        Example:    python3 blue_ss_cctv.py -d -hn 192.168.1.2 -p http -u admin -t password123
+    """
+    def __init__(self, server, path=socket_path, port=daemon_port):
+        self.server = server
+        self.path = path
+        self.port = port
+
+    #Function to answer every request on a connection ({"command": <command>, "arguments": <args>} in, the result dict out. {"script": [<lines>]} gets a line per command and then the summary)
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode())
+                    if "script" in request:
+                        reply = await run_script(self.server, request["script"], lambda result: writer.write((json.dumps(result, default=str) + "\n").encode()))
+                    else:
+                        reply = await self.server.execute(request["command"], request.get("arguments"))
+                except Exception as error:
+                    logger.error("Bad request on the daemon socket")
+                    reply = {"ok": False, "error": str(error)}
+
+                writer.write((json.dumps(reply, default=str) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    #Function to log in once and then serve the socket forever
+    async def serve(self):
+        #Never take the socket from a daemon that is still answering on it
+        running = connect_daemon(self.path, self.port)
+        if running is not None:
+            running.close()
+            logger.critical("A daemon is already listening on %s! Closing!", self.path if hasattr(socket, "AF_UNIX") else "127.0.0.1:%s" % self.port)
+            return
+
+        await self.server.connect()
+
+        try:
+            if hasattr(socket, "AF_UNIX"):
+                #Nothing answered, so anything left at the path is a stale socket from a daemon that died
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                listener = await asyncio.start_unix_server(self.handle, path=self.path)
+                os.chmod(self.path, 0o600)
+                logger.info("Daemon listening on %s", self.path)
+            else:
+                listener = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+                logger.info("Daemon listening on 127.0.0.1:%s", self.port)
+
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            await self.server.close()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+#Function to open a connection to a running daemon. Returns None if no daemon is listening
+def connect_daemon(path=socket_path, port=daemon_port):
+    try:
+        if hasattr(socket, "AF_UNIX"):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(2)
+            connection.connect(path)
+        else:
+            connection = socket.create_connection(("127.0.0.1", port), timeout=2)
+    except OSError:
+        return None
+
+    return connection
+
+#Function for the thin client - hand a command to a running daemon and return its reply. Returns None if no daemon is listening
+def send_command(command, args=None, path=socket_path, port=daemon_port):
+    connection = connect_daemon(path, port)
+    if connection is None:
+        return None
+
+    with connection:
+        connection.settimeout(60)
+        connection.sendall((json.dumps({"command": command, "arguments": args}) + "\n").encode())
+        reply = connection.makefile("rb").readline()
+
+    return json.loads(reply.decode()) if reply else None
+
+#Function to hand a command script to a running daemon. Each result is handed to emit as it arrives and the summary is returned. Returns None if no daemon is listening
+def send_script(lines, emit, path=socket_path, port=daemon_port):
+    connection = connect_daemon(path, port)
+    if connection is None:
+        return None
+
+    with connection:
+        connection.settimeout(60)
+        connection.sendall((json.dumps({"script": list(lines)}) + "\n").encode())
+        replies = connection.makefile("rb")
+        while True:
+            reply = replies.readline()
+            if not reply:
+                return {"ok": False, "command": "script", "error": "the daemon closed the connection part way through the script"}
+            reply = json.loads(reply.decode())
+            if reply.get("command") == "script" or "line" not in reply:
+                return reply
+            emit(reply)
+
+#Function to run a single command in this process when there is no daemon to hand it to (connect, run, close)
+async def run_once(host, user, token, protocol, command, args, limit=8, timeout=10, retries=2):
+    server = ssblue_iris(host, user, token, protocol, limit, timeout=timeout, retries=retries)
+    try:
+        await server.connect()
+        return await server.execute(command, args)
+    finally:
+        await server.close()
+
+#Function to run a command script in this process on one session when there is no daemon to hand it to
+async def run_script_once(host, user, token, protocol, lines, emit, limit=8, timeout=10, retries=2):
+    server = ssblue_iris(host, user, token, protocol, limit, timeout=timeout, retries=retries)
+    try:
+        await server.connect()
+        return await run_script(server, lines, emit)
+    finally:
+        await server.close()
+
+#Function to print one result as a JSON line straight away so automation can follow along
+def print_reply(reply):
+    print(json.dumps(reply, default=str), flush=True)
         
 
 ### THE THING ###
@@ -160,17 +793,60 @@ if __name__ == '__main__':
     #Set up and parse through the arguments in order to determine what we need to do
     parser = argparse.ArgumentParser()
     required_args = parser.add_argument_group('required arguments')
-    required_args.add_argument("-hn", dest="host", required=True, type=str) #host arg
-    required_args.add_argument("-p", dest="protocol",required=True, type=int) #protocol arg
-    required_args.add_argument("-u", dest="user",required=True, type=str) #username arg
-    required_args.add_argument("-t", dest="token",required=True, type=str) #token/pw arg
-    required_args.add_argument("-c", dest="command",required=True, type=str) #Command arg
+    required_args.add_argument("-hn", dest="host", required=False, type=str) #host arg (not needed when a daemon is running)
+    required_args.add_argument("-p", dest="protocol",required=False, type=str) #protocol arg
+    required_args.add_argument("-u", dest="user",required=False, type=str) #username arg
+    required_args.add_argument("-t", dest="token",required=False, type=str) #token/pw arg
+    required_args.add_argument("-c", dest="command",required=False, type=str) #Command arg
     required_args.add_argument("-a", dest="arguments",required=False, type=str) #Arguments for command if required
+    parser.add_argument("-d", dest="daemon", action="store_true") #Run as the long lived control daemon
+    parser.add_argument("-s", dest="socket", required=False, type=str, default=socket_path) #Unix socket for the daemon
+    parser.add_argument("--local", dest="local", action="store_true") #Always run the command in this process, even if a daemon is running
+    parser.add_argument("-b", dest="script", required=False, type=str) #Run a command script ('-' for stdin) - one command per line, results come back one JSON line each
+    parser.add_argument("-l", dest="limit", required=False, type=int, default=8) #Most BlueIris requests in flight at once for multi-camera commands
+    parser.add_argument("--timeout", dest="timeout", required=False, type=float, default=10) #Seconds to wait for each BlueIris call
+    parser.add_argument("--retries", dest="retries", required=False, type=int, default=2) #Times a failed BlueIris call is tried again
+    parser.add_argument("--ttl", dest="ttl", required=False, type=float, default=60) #Seconds the daemon keeps the camera list and details before asking BlueIris again (0 to always ask)
 
     args = parser.parse_args()
-
-    #Connect to the BlueIris server
-    server_session = ssblue_iris(args.host, args.user, args.token, args.protocol)
-
-    #Execute what we need to based on the arg we were called with
-    ssblue_iris.execute(server_session, args.command, args.arguments)
\ No newline at end of file
+    login_args = [args.host, args.user, args.token, args.protocol]
+
+    #Daemon mode - log in once and keep going
+    if args.daemon:
+        if not all(login_args):
+            parser.error("the daemon needs -hn, -p, -u and -t")
+        cctv_daemon(ssblue_iris(args.host, args.user, args.token, args.protocol, args.limit, args.ttl, args.timeout, args.retries), args.socket).run()
+        quit()
+
+    #Script mode - run a whole command script on one session, on the daemon if there is one
+    if args.script:
+        if args.script == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.script) as script:
+                lines = script.read().splitlines()
+
+        summary = None if args.local else send_script(lines, print_reply, args.socket)
+        if summary is None:
+            if not all(login_args):
+                parser.error("no daemon is running, so -hn, -p, -u and -t are required")
+            summary = asyncio.run(run_script_once(args.host, args.user, args.token, args.protocol, lines, print_reply, args.limit, args.timeout, args.retries))
+        print_reply(summary)
+        quit(0 if summary.get("ok") else 1)
+
+    if not args.command:
+        parser.error("the following arguments are required: -c or -b")
+
+    #Thin client - if a daemon is running, let it do the work with its logged in session
+    if not args.local:
+        reply = send_command(args.command, args.arguments, args.socket)
+        if reply is not None:
+            print(json.dumps(reply, default=str))
+            quit(0 if reply.get("ok") else 1)
+
+    if not all(login_args):
+        parser.error("no daemon is running, so -hn, -p, -u and -t are required")
+
+    #Connect to the BlueIris server and execute what we need to based on the arg we were called with
+    reply = asyncio.run(run_once(args.host, args.user, args.token, args.protocol, args.command, args.arguments, args.limit, args.timeout, args.retries))
+    print(json.dumps(reply, default=str))
@@ -17,6 +17,8 @@ Purpose:
     -This script was built intended to be used in Windoes, buut is written in such a way that it should work on most platforms
     -This first iteration / version of the script is meant to be called from a bash file (which is called from BlueIris upon detection). If this prooves to not work well, we will then
         change this to run continuously looking to pull any new file out of the saved videos location
+    -It can now also run continuously as a daemon ('-d -w <clips dir>') with the models loaded once. When a daemon is running, the normal '-f' call just hands the clip to it
+    -New people are added with "--enroll <people dir> <gallery dir>" (a folder of photos per person). Only new photos are encoded, and running daemons pick the new gallery up without a restart
 
 Considerations:
     -The Haar Cascade and LBP models are used in this script for recognition. We use DLIB in order to create our dataset to run a face against
@@ -25,7 +27,6 @@ Considerations:
     -Any successful findings will get a rectangle drawn around the snapshot, a name if applicable, and then included in the email
 
 To Do:
-    -Add in files for human body detection
     -Integrate error catching
     -TESTING!!!!
 
@@ -34,17 +35,40 @@ To Do:
 ### IMPORT LIBRARIES ###
 from cv2 import cv2     # - cv2 library for image and video processing
 from datetime import datetime   #https://docs.python.org/3.8/library/datetime.html - Processing dates and times
-from os.path import dirname   #https://docs.python.org/3.8/library/os.html - For using OS features on the local machine
+from os.path import dirname, getmtime, join, isdir, basename   #https://docs.python.org/3.8/library/os.html - For using OS features on the local machine
 import logging  #https://docs.python.org/3.8/library/logging.html - Used for logging issues and actions in the script
 import argparse     #https://docs.python.org/3.8/library/argparse.html - Used for parsing through arguments handed to the script
 import time     #https://docs.python.org/3.8/library/time.html - Used for waiting on different things
-import face_recognition #https://pypi.org/project/face-recognition/ - For actually recognising and processing facial images
 import pickle   #https://docs.python.org/3.8/library/pickle.html - For saving files to the local machine and later use
 import smtplib  #https://docs.python.org/3.8/library/smtplib.html - For email using SSL and TLS
 import ssl     #https://docs.python.org/3.8/library/ssl.html - For email using SSL and TLS
+import sqlite3  #https://docs.python.org/3.8/library/sqlite3.html - For the result cache
+import hashlib  #https://docs.python.org/3.8/library/hashlib.html - For hashing clip contents for the result cache
+from email.message import EmailMessage  #https://docs.python.org/3.8/library/email.message.html - For building alert emails with the snapshots attached
+import math    #https://docs.python.org/3.8/library/math.html - For working out frame sampling steps
+import numpy as np  #https://numpy.org/doc/stable/ - For vectorized matching of face encodings against the gallery
+import json     #https://docs.python.org/3.8/library/json.html - For reading and writing the gallery header
+import os       #https://docs.python.org/3.8/library/os.html - For creating gallery directories and swapping files into place
+import queue    #https://docs.python.org/3.8/library/queue.html - For queueing clips up for the daemon to work through
+import threading    #https://docs.python.org/3.8/library/threading.html - For running the daemon watcher, socket server and worker side by side
+import socket   #https://docs.python.org/3.8/library/socket.html - For handing clips to a running daemon
+import socketserver #https://docs.python.org/3.8/library/socketserver.html - For the daemon's local socket
+import multiprocessing  #https://docs.python.org/3.8/library/multiprocessing.html - For fanning a backlog of clips out over all the cores
+import glob     #https://docs.python.org/3.8/library/glob.html - For finding the clips to batch process
+from concurrent.futures import ThreadPoolExecutor   #https://docs.python.org/3.8/library/concurrent.futures.html - For running the cascades side by side (OpenCV lets go of the GIL while detecting)
+import cProfile #https://docs.python.org/3.8/library/profile.html - For dumping a full profile of a clip when asked to
+#face_recognition (https://pypi.org/project/face-recognition/) is imported in parse_config - importing it loads the dlib models, which the thin client never needs
 
 ### DEFINE VARIABLES ###
 project_root = dirname(__file__)   #Defines the root directory the script is currently in
+gallery_format = "blue_ss_gallery"  #Name written into the header of every gallery directory
+gallery_version = 2                 #Version of the gallery directory layout this script writes (version 1 galleries can still be read)
+pipeline_version = 1                #Bump this whenever a change to the pipeline should invalidate cached results
+encode_lock = threading.Lock()      #dlib's models are not safe to use from two threads at once
+gallery_lock = threading.Lock()     #Only one thread reloads the gallery when it changes
+gallery_mtime = None                #When the loaded gallery was last changed on disk
+gallery_signature = None            #Size and version of the loaded gallery, for the result cache
+camera_setting_names = ["motion_pixel_threshold", "motion_min_area", "detect_width", "roi"]    #Settings that can be overridden per camera with '<setting>_<camera name>:<value>' rows
 
 #Set up logging for user activities
 logging_file = project_root + "\\blue_ss_facial.log"         #Define log file location for windows
@@ -58,11 +82,77 @@ fh.setFormatter(formatter)
 
 ### CLASSES AND FUNCTIONS ###
 #Function to parse through config to script related dependencies
-def parse_config():
+def parse_config(threads=0):
     #Set global variables
-    global smtp_server, smtp_port, alert_email, alert_password, alert_list, dlib, haar_frontal, haar_profile, lbp_frontal, lbp_profile, save_location
+    global face_recognition, smtp_server, smtp_port, alert_email, alert_password, alert_list, save_location, sample_mode, sample_rate, max_frames, match_tolerance, dlib_file, gallery_dir, index_type, index_lists, index_nprobe, camera_settings, motion_gate_enabled, motion_width, motion_pixel_threshold, motion_min_area, motion_learning_rate, detect_width, track_iou, track_max_gap, track_best_crops, snapshot_format, snapshot_quality, snapshot_mode, snapshot_max_width, snapshot_queue, writer, alert_window, alert_thumb_width, alert_max_images, alerts, cache_enabled, cache_file, cache_max_entries, cache_max_age_days, cache, profile_dir, person_enabled, person_width, person_every, person_frames, person_min_weight, people, cascade_files, detect_threads, daemon_workers, detectors
+
+    #For actually recognising and processing facial images (see the note in the imports)
+    import face_recognition
 
     alert_list = [] #List to hold users to send out alerts to
+    dlib_file = None    #Pickled dlib encodings (older format)
+    gallery_dir = None  #Memory mapped gallery directory (preferred when set)
+
+    #Frame sampling defaults (can be overridden in the config file)
+    sample_mode = "fps"     #How to pick frames out of a clip - 'nth', 'fps' or 'keyframes'
+    sample_rate = 2         #N for the 'nth' and 'fps' sampling modes
+    max_frames = 60         #Most frames we will ever decode from a single clip (0 for no limit)
+    match_tolerance = 0.6   #Largest encoding distance that still counts as a match (same default as face_recognition)
+
+    #Gallery index defaults (exact search unless the config asks for an index)
+    index_type = "none"     #'none' for an exact scan of the gallery or 'ivf' for the approximate inverted file index
+    index_lists = 0         #Number of coarse clusters in the ivf index (0 to size it from the gallery)
+    index_nprobe = 8        #Clusters to search per face - higher gives better recall, lower gives faster matching
+
+    #Motion gate defaults (the thresholds can also be set per camera)
+    motion_gate_enabled = True      #Only run the detectors on frames with enough movement in them
+    motion_width = 160              #Width the frame is shrunk to before looking for movement
+    motion_pixel_threshold = 25     #How much a pixel has to change (0-255) to count as moving
+    motion_min_area = 0.002         #Fraction of the frame that has to be moving for it to go on to detection
+    motion_learning_rate = 0.1      #How quickly the background model soaks up changes (0-1)
+    camera_settings = {}            #Per camera overrides keyed by (setting, camera name)
+
+    #Detection resolution default (can also be set per camera)
+    detect_width = 0                #Width frames are shrunk to before running the cascades (0 to detect at full resolution)
+
+    #Detector thread pool defaults
+    cascade_files = {}              #Cascade name -> xml file, so each detector thread can load its own copy
+    detect_threads = min(4, multiprocessing.cpu_count())   #Threads to run the cascades on (1 to run them one after another)
+    daemon_workers = 1              #Clips the daemon works on at the same time (they share the detector threads)
+
+    #Person detection defaults
+    person_enabled = True           #Look for people (HOG) in clips where no face was found
+    person_width = 640              #Width frames are shrunk to before looking for people
+    person_every = 2                #Only keep every Nth frame that got past the motion gate for person detection
+    person_frames = 15              #Most frames per clip to run person detection on
+    person_min_weight = 0.5         #Lowest HOG score that still counts as a person
+
+    #Face tracking defaults
+    track_iou = 0.3                 #How much a box has to overlap a track to join it
+    track_max_gap = 3               #How many sampled frames a track can go without a detection before it is closed
+    track_best_crops = 3            #How many of the best face crops per track get encoded
+
+    #Snapshot defaults
+    snapshot_format = "jpg"         #Image format for snapshots - 'jpg', 'webp' or 'png'
+    snapshot_quality = 90           #Quality for jpg/webp snapshots (0-100)
+    snapshot_mode = "full"          #'full' for the whole frame, 'face' for a thumbnail of the face or 'both'
+    snapshot_max_width = 0          #Shrink saved full frames to this width (0 to keep full resolution)
+    snapshot_queue = 32             #Most snapshots waiting to be written before we start dropping them
+
+    #Alert defaults
+    alert_window = 0                #Seconds to keep collecting detections (across clips) before sending one alert (0 for one alert per clip)
+    alert_thumb_width = 480         #Width of the snapshots attached to the alert email
+    alert_max_images = 6            #Most snapshots attached to a single alert email
+
+    #Result cache defaults
+    cache_enabled = True            #Skip clips we have already processed (same contents, same pipeline and gallery)
+    cache_file = join(project_root, "blue_ss_facial_cache.db")  #SQLite file to keep cached results in
+    cache_max_entries = 1000        #Most clips to keep results for
+    cache_max_age_days = 7          #Oldest cached result to keep
+    cache = None
+
+    #Profiling default
+    profile_dir = None              #Directory to dump a cProfile of every clip into (off unless set)
 
     #Open the config file
     try:
@@ -73,46 +163,103 @@ def parse_config():
                 #Pull out files we need for recognition
                 try:
                     if "dlib:" in row:
-                        dlib = pickle.loads(open((row.split("dlib:")[1].replace("\n", "")), "rb").read())
+                        dlib_file = (row.split("dlib:")[1].replace("\n", ""))
                 except:
                         logger.error("Unable to read dlib file from config file! Please check syntax!")
                         quit()
 
+                try:
+                    if "gallery:" in row:
+                        gallery_dir = (row.split("gallery:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read gallery from config file! Please check syntax!")
+                        quit()
+
                 try:
                     if "haar_frontal:" in row:
-                        haar_frontal = cv2.CascadeClassifier((row.split("haar_frontal:")[1].replace("\n", "")))
+                        cascade_files["haar_frontal"] = row.split("haar_frontal:")[1].replace("\n", "")
                 except:
                         logger.error("Unable to read haar_frontal file from config file! Please check syntax!")
                         quit()
 
                 try:
                     if "haar_profile:" in row:
-                        haar_profile = cv2.CascadeClassifier((row.split("haar_profile:")[1].replace("\n", "")))
+                        cascade_files["haar_profile"] = row.split("haar_profile:")[1].replace("\n", "")
                 except:
                         logger.error("Unable to read haar_profile file from config file! Please check syntax!")
                         quit()
 
                 try:
                     if "lbp_frontal:" in row:
-                        lbp_frontal = cv2.CascadeClassifier((row.split("lbp_frontal:")[1].replace("\n", "")))
+                        cascade_files["lbp_frontal"] = row.split("lbp_frontal:")[1].replace("\n", "")
                 except:
                         logger.error("Unable to read lbp_frontal file from config file! Please check syntax!")
                         quit()
 
                 try:
                     if "lbp_profile:" in row:
-                        lbp_profile = cv2.CascadeClassifier((row.split("lbp_profile:")[1].replace("\n", "")))
+                        cascade_files["lbp_profile"] = row.split("lbp_profile:")[1].replace("\n", "")
                 except:
                         logger.error("Unable to read lbp_profile file from config file! Please check syntax!")
                         quit()
 
                 try:
                     if "save_location:" in row:
-                        save_location = f'{(row.split("save_location:")[1].replace("\n", ""))}{"%Y%m%d-%H%M%S%f_face.png"}'
+                        save_location = (row.split("save_location:")[1].replace("\n", "")) + "%Y%m%d-%H%M%S%f_face"
                 except:
                         logger.error("Unable to read save_location file from config file! Please check syntax!")
                         quit()
 
+                #Pull out frame sampling settings
+                try:
+                    if "sample_mode:" in row:
+                        sample_mode = (row.split("sample_mode:")[1].replace("\n", "")).strip().lower()
+                except:
+                        logger.error("Unable to read sample_mode from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "sample_rate:" in row:
+                        sample_rate = float(row.split("sample_rate:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read sample_rate from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "max_frames:" in row:
+                        max_frames = int(row.split("max_frames:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read max_frames from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "match_tolerance:" in row:
+                        match_tolerance = float(row.split("match_tolerance:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read match_tolerance from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "index_type:" in row:
+                        index_type = (row.split("index_type:")[1].replace("\n", "")).strip().lower()
+                except:
+                        logger.error("Unable to read index_type from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "index_lists:" in row:
+                        index_lists = int(row.split("index_lists:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read index_lists from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "index_nprobe:" in row:
+                        index_nprobe = int(row.split("index_nprobe:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read index_nprobe from config file! Please check syntax!")
+                        quit()
+
                 #Pull out notification settings
                 try:
                     if "smtp_server:" in row:
@@ -149,10 +296,1682 @@ def parse_config():
                         logger.error("Unable to read alert_contacts from config file! Please check syntax!")
                         quit()
 
+                #Pull out motion gate settings
+                try:
+                    if "motion_gate:" in row:
+                        motion_gate_enabled = (row.split("motion_gate:")[1].replace("\n", "")).strip().lower() in ("on", "true", "yes", "1")
+                except:
+                        logger.error("Unable to read motion_gate from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "motion_width:" in row:
+                        motion_width = int(row.split("motion_width:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read motion_width from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "motion_pixel_threshold:" in row:
+                        motion_pixel_threshold = int(row.split("motion_pixel_threshold:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read motion_pixel_threshold from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "motion_min_area:" in row:
+                        motion_min_area = float(row.split("motion_min_area:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read motion_min_area from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "motion_learning_rate:" in row:
+                        motion_learning_rate = float(row.split("motion_learning_rate:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read motion_learning_rate from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "detect_width:" in row:
+                        detect_width = int(row.split("detect_width:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read detect_width from config file! Please check syntax!")
+                        quit()
+
+                #Pull out detector thread pool settings
+                try:
+                    if "detect_threads:" in row:
+                        detect_threads = max(1, int(row.split("detect_threads:")[1].replace("\n", "")))
+                except:
+                        logger.error("Unable to read detect_threads from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "daemon_workers:" in row:
+                        daemon_workers = max(1, int(row.split("daemon_workers:")[1].replace("\n", "")))
+                except:
+                        logger.error("Unable to read daemon_workers from config file! Please check syntax!")
+                        quit()
+
+                #Pull out person detection settings
+                try:
+                    if "person_detection:" in row:
+                        person_enabled = (row.split("person_detection:")[1].replace("\n", "")).strip().lower() in ("on", "true", "yes", "1")
+                except:
+                        logger.error("Unable to read person_detection from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "person_width:" in row:
+                        person_width = int(row.split("person_width:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read person_width from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "person_every:" in row:
+                        person_every = max(1, int(row.split("person_every:")[1].replace("\n", "")))
+                except:
+                        logger.error("Unable to read person_every from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "person_frames:" in row:
+                        person_frames = int(row.split("person_frames:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read person_frames from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "person_min_weight:" in row:
+                        person_min_weight = float(row.split("person_min_weight:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read person_min_weight from config file! Please check syntax!")
+                        quit()
+
+                #Pull out face tracking settings
+                try:
+                    if "track_iou:" in row:
+                        track_iou = float(row.split("track_iou:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read track_iou from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "track_max_gap:" in row:
+                        track_max_gap = int(row.split("track_max_gap:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read track_max_gap from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "track_best_crops:" in row:
+                        track_best_crops = int(row.split("track_best_crops:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read track_best_crops from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "alert_window:" in row:
+                        alert_window = float(row.split("alert_window:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read alert_window from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "alert_thumb_width:" in row:
+                        alert_thumb_width = int(row.split("alert_thumb_width:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read alert_thumb_width from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "alert_max_images:" in row:
+                        alert_max_images = int(row.split("alert_max_images:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read alert_max_images from config file! Please check syntax!")
+                        quit()
+
+                #Pull out result cache settings
+                try:
+                    if "cache:" in row and not row.startswith("cache_"):
+                        cache_enabled = (row.split("cache:")[1].replace("\n", "")).strip().lower() in ("on", "true", "yes", "1")
+                except:
+                        logger.error("Unable to read cache from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "cache_file:" in row:
+                        cache_file = (row.split("cache_file:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read cache_file from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "cache_max_entries:" in row:
+                        cache_max_entries = int(row.split("cache_max_entries:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read cache_max_entries from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "cache_max_age_days:" in row:
+                        cache_max_age_days = float(row.split("cache_max_age_days:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read cache_max_age_days from config file! Please check syntax!")
+                        quit()
+
+                #Pull out profiling settings
+                try:
+                    if "profile_dir:" in row:
+                        profile_dir = (row.split("profile_dir:")[1].replace("\n", "")).strip() or None
+                except:
+                        logger.error("Unable to read profile_dir from config file! Please check syntax!")
+                        quit()
+
+                #Pull out snapshot settings
+                try:
+                    if "snapshot_format:" in row:
+                        snapshot_format = (row.split("snapshot_format:")[1].replace("\n", "")).strip().lower().lstrip(".").replace("jpeg", "jpg")
+                except:
+                        logger.error("Unable to read snapshot_format from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "snapshot_quality:" in row:
+                        snapshot_quality = int(row.split("snapshot_quality:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read snapshot_quality from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "snapshot_mode:" in row:
+                        snapshot_mode = (row.split("snapshot_mode:")[1].replace("\n", "")).strip().lower()
+                except:
+                        logger.error("Unable to read snapshot_mode from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "snapshot_max_width:" in row:
+                        snapshot_max_width = int(row.split("snapshot_max_width:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read snapshot_max_width from config file! Please check syntax!")
+                        quit()
+
+                try:
+                    if "snapshot_queue:" in row:
+                        snapshot_queue = int(row.split("snapshot_queue:")[1].replace("\n", ""))
+                except:
+                        logger.error("Unable to read snapshot_queue from config file! Please check syntax!")
+                        quit()
+
+                #Pull out any per camera overrides ('<setting>_<camera name>:<value>')
+                try:
+                    for setting in camera_setting_names:
+                        if row.startswith(setting + "_") and ":" in row:
+                            camera = row.split(":")[0][len(setting) + 1:].strip().lower()
+                            camera_settings[(setting, camera)] = row.split(":", 1)[1].replace("\n", "").strip()
+                except:
+                        logger.error("Unable to read per camera setting from config file! Please check syntax! %s", row)
+                        quit()
+
     except:
         logger.critical("Error Occurred when opening config file! Closing!")
         quit()
 
+    #Start the background snapshot writer so detection never waits on the disk
+    writer = snapshot_writer(snapshot_format, snapshot_quality, snapshot_mode, snapshot_max_width, snapshot_queue)
+
+    #Collect detections into one alert per clip (or per time window)
+    alerts = alert_aggregator(alert_window, alert_thumb_width, alert_max_images)
+
+    #The detector threads load their own copies of the cascades, so make sure every one of them was set
+    for name in ["haar_frontal", "haar_profile", "lbp_frontal", "lbp_profile"]:
+        if name not in cascade_files:
+            logger.critical("No %s file set in the config file! Closing!", name)
+            quit()
+
+    #Thread pool the cascades run on (batch workers hand in their share of the cores)
+    if threads:
+        detect_threads = threads
+    detectors = detector_pool(cascade_files, detect_threads)
+
+    #HOG people detector for clips where nobody shows us their face
+    people = person_detector(person_width, person_min_weight) if person_enabled else None
+
+    #Load the gallery into the matcher once so every frame can reuse it. A gallery directory is memory mapped, the old pickle has to be read in full
+    try:
+        load_gallery()
+    except:
+        logger.critical("Unable to load the gallery into the face matcher! Closing!")
+        quit()
+
+    #Open the result cache. Cached results are only reused for the same pipeline settings and the same gallery
+    if cache_enabled:
+        try:
+            settings = [pipeline_version, sample_mode, sample_rate, max_frames, match_tolerance, index_type, index_nprobe, motion_gate_enabled, motion_width, motion_pixel_threshold, motion_min_area, detect_width, track_iou, track_max_gap, track_best_crops, person_enabled, person_width, person_every, person_frames, person_min_weight, sorted(camera_settings.items())]
+            cache = result_cache(cache_file, json.dumps(settings, default=str), gallery_signature, cache_max_entries, cache_max_age_days)
+        except:
+            logger.error("Unable to open the result cache at %s! Carrying on without it", cache_file)
+
+#Function to load the gallery (and its ivf index if the config asks for one) into the matcher. Run at startup, and again by reload_gallery when the gallery changes on disk
+def load_gallery():
+    global dlib, matcher, gallery_mtime, gallery_signature
+
+    if gallery_dir:
+        index_source = join(gallery_dir, "header.json")
+        mtime = getmtime(index_source)
+        dlib = open_gallery(gallery_dir)
+        loaded = face_matcher(dlib["encodings"], dlib["names"], match_tolerance, dlib["name_ids"], dlib["norms"])
+        index_file = join(gallery_dir, "index.ivf.npz")
+        generation = dlib["generation"]
+
+    else:
+        index_source = dlib_file
+        mtime = getmtime(index_source)
+        dlib = pickle.loads(open(dlib_file, "rb").read())
+        loaded = face_matcher(dlib["encodings"], dlib["names"], match_tolerance)
+        index_file = dlib_file + ".ivf.npz"
+        generation = None
+
+    #Put the approximate index in front of the matcher if the config asks for it (built once and saved next to the gallery). There is nothing to index until someone is enrolled
+    if index_type == "ivf" and len(loaded.name_ids):
+        try:
+            loaded.index = open_ivf_index(index_file, loaded.encodings, index_lists, index_nprobe, index_source, generation)
+        except:
+            logger.error("Unable to load or build the ivf index! Falling back to exact matching")
+
+    #Swap the new gallery in whole, so a clip being worked on never sees half of one
+    matcher = loaded
+    gallery_mtime = mtime
+    gallery_signature = f"{len(matcher.name_ids)}:{mtime if generation is None else generation}"
+
+    #Results cached against the old gallery no longer count
+    if cache is not None:
+        cache.rekey(gallery_signature)
+
+#Function to pick up a gallery that has changed on disk (people enrolled) without a restart. Only a stat of the gallery file, so it is run before every clip
+def reload_gallery():
+    try:
+        mtime = getmtime(join(gallery_dir, "header.json") if gallery_dir else dlib_file)
+    except OSError:
+        return False
+
+    if mtime == gallery_mtime:
+        return False
+
+    with gallery_lock:
+        if mtime == gallery_mtime:
+            return False
+
+        try:
+            load_gallery()
+            logger.info("Reloaded the gallery after it changed on disk (%s encodings)", len(matcher.name_ids))
+            return True
+        except:
+            logger.error("Unable to reload the gallery, carrying on with the one already loaded")
+            return False
+
+#Class to match face encodings against the gallery. The gallery is held as one contiguous float32 matrix so a whole frame of faces is matched in one batched operation
+class face_matcher:
+    """
+        :param encodings:       The gallery encodings from the dlib file (required)
+        :param names:           The name for each gallery encoding, or the name table when name_ids is given (required)
+        :param tolerance:       Largest distance between two encodings that still counts as a match
+        :param name_ids:        Name table index for each gallery encoding (from a gallery directory)
+        :param gallery_norms:   Squared norm of each gallery encoding (from a gallery directory)
+
+        Example:    face_matcher(dlib["encodings"], dlib["names"]).match(encodings)
+    """
+    def __init__(self, encodings, names, tolerance=0.6, name_ids=None, gallery_norms=None):
+        self.tolerance = tolerance
+
+        #Memory mapped float32 galleries pass straight through here without being copied
+        self.encodings = np.asarray(encodings, dtype=np.float32)
+        if self.encodings.size == 0:
+            #An empty gallery (nobody enrolled yet) still matches - everyone just comes back Unknown
+            self.encodings = np.empty((0, 128), dtype=np.float32)
+        elif self.encodings.ndim != 2:
+            self.encodings = self.encodings.reshape(len(self.encodings), -1)
+        if not self.encodings.flags["C_CONTIGUOUS"]:
+            self.encodings = np.ascontiguousarray(self.encodings)
+
+        #Turn the names into integer IDs so the votes can be tallied with bincount
+        if name_ids is None:
+            self.name_list, self.name_ids = np.unique(np.asarray(names), return_inverse=True)
+            self.name_list = [str(name) for name in self.name_list]
+            self.name_ids = self.name_ids.astype(np.int64)
+        else:
+            self.name_list = list(names)
+            self.name_ids = name_ids
+
+        #Squared norms of the gallery are used for every distance calculation, so work them out once (unless the gallery already has them)
+        if gallery_norms is None:
+            self.gallery_norms = np.einsum("ij,ij->i", self.encodings, self.encodings)
+        else:
+            self.gallery_norms = gallery_norms
+
+        #Optional approximate index (ivf_index) used to cut down which gallery rows we compare against
+        self.index = None
+
+        logger.info("Loaded %s encodings for %s people into the face matcher", len(self.name_ids), len(self.name_list))
+
+    #Function to get the distance between every query encoding and the given gallery rows (queries x gallery)
+    def distances(self, queries, gallery, gallery_norms):
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        squared = query_norms[:, None] + gallery_norms[None, :] - 2.0 * (queries @ gallery.T)
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    #Function to match a list of encodings and return (name, distance, confidence) for each one
+    def match(self, encodings):
+        if len(encodings) == 0 or len(self.name_ids) == 0:
+            return [("Unknown", float("inf"), 0.0) for encoding in encodings]
+
+        queries = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1)
+
+        #Either compare against the whole gallery, or only the rows the index hands back for this frame's faces
+        if self.index is not None:
+            candidates = self.index.candidates(queries)
+            name_ids = self.name_ids[candidates]
+            distances = self.distances(queries, self.encodings[candidates], self.gallery_norms[candidates])
+        else:
+            name_ids = self.name_ids
+            distances = self.distances(queries, self.encodings, self.gallery_norms)
+
+        if distances.shape[1] == 0:
+            return [("Unknown", float("inf"), 0.0) for query in queries]
+
+        #Tally the matched gallery rows per name for every face at once (face index and name ID flattened into one bincount)
+        name_count = len(self.name_list)
+        rows, cols = np.nonzero(distances <= self.tolerance)
+        votes = np.bincount(rows * name_count + name_ids[cols], minlength=len(queries) * name_count).reshape(len(queries), name_count)
+
+        best_ids = votes.argmax(axis=1)
+        best_votes = votes[np.arange(len(queries)), best_ids]
+        total_votes = votes.sum(axis=1)
+
+        #Closest distance to any encoding of the winning name (or to anything at all if nobody matched)
+        same_name = name_ids[None, :] == best_ids[:, None]
+        best_distances = np.where(same_name, distances, np.inf).min(axis=1)
+        closest = distances.min(axis=1)
+
+        results = []
+        for i in range(len(queries)):
+            if best_votes[i] == 0:
+                results.append(("Unknown", float(closest[i]), 0.0))
+            else:
+                #Confidence is the share of all matching gallery rows that voted for the winner
+                results.append((self.name_list[best_ids[i]], float(best_distances[i]), float(best_votes[i] / total_votes[i])))
+
+        return results
+
+#Function to open a gallery directory. The encodings, name IDs and norms are memory mapped so startup does not depend on gallery size and worker processes share the same pages
+def open_gallery(gallery_dir):
+    with open(join(gallery_dir, "header.json")) as file:
+        header = json.load(file)
+
+    if header.get("format") != gallery_format or header.get("version") not in (1, gallery_version):
+        raise ValueError(f'{gallery_dir} is not a version 1 or {gallery_version} gallery (found {header.get("format")} version {header.get("version")})')
+
+    rows, dims = header["rows"], header.get("dims", 128)
+    if header["version"] == 1:
+        encodings = np.load(join(gallery_dir, "encodings.npy"), mmap_mode="r")
+        name_ids = np.load(join(gallery_dir, "name_ids.npy"), mmap_mode="r")
+        norms = np.load(join(gallery_dir, "norms.npy"), mmap_mode="r")
+
+    #Version 2 data files are append-only raw arrays. Only the rows the header counts are used, so a half finished append is never seen
+    elif rows == 0:
+        encodings, name_ids, norms = np.empty((0, dims), dtype=np.float32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    else:
+        files = header["files"]
+        encodings = np.memmap(join(gallery_dir, files["encodings"]), dtype=np.float32, mode="r", shape=(rows, dims))
+        name_ids = np.memmap(join(gallery_dir, files["name_ids"]), dtype=np.int64, mode="r", shape=(rows,))
+        norms = np.memmap(join(gallery_dir, files["norms"]), dtype=np.float32, mode="r", shape=(rows,))
+
+    gallery = {
+        "encodings": encodings,
+        "name_ids": name_ids,
+        "norms": norms,
+        "names": header["names"],
+        "version": header["version"],
+        "generation": header.get("generation", 0),
+        "header": header,
+    }
+
+    if len(gallery["encodings"]) != rows or len(gallery["name_ids"]) != rows:
+        raise ValueError(f'{gallery_dir} has {len(gallery["encodings"])} encodings but the header says {rows}')
+
+    logger.info("Opened gallery %s (generation %s) with %s encodings for %s people", gallery_dir, gallery["generation"], rows, len(header["names"]))
+    return gallery
+
+#Function to swap a new gallery header into place. The header is always written last, so it is what makes a change visible to readers
+def write_gallery_header(gallery_dir, header):
+    with open(join(gallery_dir, "header.json.tmp"), "w") as file:
+        json.dump(header, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(join(gallery_dir, "header.json.tmp"), join(gallery_dir, "header.json"))
+
+#Function to write a gallery directory from a list of encodings and their names. Every save gets a fresh set of data files, so a running process keeps reading the old ones until it reloads
+def save_gallery(gallery_dir, encodings, names, images=None, generation=0, dims=128):
+    encodings = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(len(names), dims))
+    name_list, name_ids = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+
+    if not isdir(gallery_dir):
+        os.makedirs(gallery_dir)
+
+    generation += 1
+    files = {"encodings": f"encodings.{generation}.f32", "name_ids": f"name_ids.{generation}.i64", "norms": f"norms.{generation}.f32"}
+    encodings.tofile(join(gallery_dir, files["encodings"]))
+    name_ids.astype(np.int64).tofile(join(gallery_dir, files["name_ids"]))
+    np.einsum("ij,ij->i", encodings, encodings).astype(np.float32).tofile(join(gallery_dir, files["norms"]))
+
+    #Header goes in last (and is swapped into place) so a half written gallery is never picked up
+    header = {"format": gallery_format, "version": gallery_version, "generation": generation, "rows": len(encodings), "dims": dims, "dtype": "float32", "names": [str(name) for name in name_list], "files": files, "images": images or {}}
+    write_gallery_header(gallery_dir, header)
+
+    #Clear out data files from older saves (a reader on Windows may still have them open, so just try again next time)
+    for name in os.listdir(gallery_dir):
+        if name.split(".")[0] in files and name not in files.values():
+            try:
+                os.remove(join(gallery_dir, name))
+            except OSError:
+                pass
+
+    return header
+
+#Function to append encodings to a version 2 gallery without rewriting what is already there
+def append_gallery(gallery_dir, header, encodings, names, images=None):
+    encodings = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(len(names), -1))
+    header = dict(header)
+    header["names"] = list(header["names"])
+    for name in names:
+        if name not in header["names"]:
+            header["names"].append(name)
+
+    name_ids = np.array([header["names"].index(name) for name in names], dtype=np.int64)
+    norms = np.einsum("ij,ij->i", encodings, encodings).astype(np.float32)
+    rows = header["rows"]
+
+    for (key, array, row_size) in (("encodings", encodings, 4 * header["dims"]), ("name_ids", name_ids, 8), ("norms", norms, 4)):
+        path = join(gallery_dir, header["files"][key])
+        with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+            #Drop anything a crashed append left past the rows the header knows about
+            file.truncate(rows * row_size)
+            file.seek(0, os.SEEK_END)
+            file.write(array.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+
+    header["rows"] = rows + len(encodings)
+    header["generation"] = header.get("generation", 0) + 1
+    header["images"] = dict(header.get("images", {}), **(images or {}))
+    write_gallery_header(gallery_dir, header)
+    return header
+
+#Function to do a one-shot conversion of a pickled dlib encodings file into a gallery directory
+def convert_gallery(pickle_file, gallery_dir):
+    with open(pickle_file, "rb") as file:
+        data = pickle.load(file)
+
+    save_gallery(gallery_dir, data["encodings"], data["names"])
+    logger.info("Converted %s encodings from %s into gallery %s", len(data["names"]), pickle_file, gallery_dir)
+    print(f'Converted {len(data["names"])} encodings into {gallery_dir}. Set "gallery:{gallery_dir}" in blue_ss_facial.conf to use it')
+
+#Function to work out the encoding for an enrollment photo (the biggest face in it), or None if there is no face
+def enroll_encoding(image_file):
+    image = face_recognition.load_image_file(image_file)
+    locations = face_recognition.face_locations(image)
+    if not locations:
+        return None
+
+    biggest = max(locations, key=lambda location: (location[2] - location[0]) * (location[1] - location[3]))
+    return face_recognition.face_encodings(image, known_face_locations=[biggest])[0]
+
+#Function to enroll people into a gallery directory from a folder of photos per person (people_dir/<name>/*.jpg). Photos are tracked by file hash so only new or changed ones get encoded, and new rows are appended to the gallery
+def enroll_gallery(people_dir, gallery_dir):
+    #Encoding needs the dlib models (see the note in the imports)
+    global face_recognition
+    import face_recognition
+
+    people_dir = os.path.abspath(people_dir)
+    if os.path.exists(join(gallery_dir, "header.json")):
+        gallery = open_gallery(gallery_dir)
+        header = gallery["header"]
+    else:
+        gallery, header = None, None
+    enrolled = {key: dict(image) for (key, image) in header.get("images", {}).items()} if header else {}
+
+    #Hash every photo under the people directory
+    found = {}
+    for name in sorted(os.listdir(people_dir)):
+        if not isdir(join(people_dir, name)):
+            continue
+        for image_name in sorted(os.listdir(join(people_dir, name))):
+            if image_name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")):
+                image_file = join(people_dir, name, image_name)
+                with open(image_file, "rb") as file:
+                    found[hashlib.sha256(file.read()).hexdigest()] = {"name": name, "file": image_file}
+
+    #Photos from this directory that were deleted, changed or moved to another person have to come back out of the gallery
+    removed = [key for (key, image) in enrolled.items() if image["file"].startswith(people_dir + os.sep) and (key not in found or found[key]["name"] != image["name"])]
+    added = [key for key in found if key not in enrolled or key in removed]
+    for key in enrolled:
+        if key in found and key not in removed:
+            enrolled[key]["file"] = found[key]["file"]
+
+    #Encode only the new photos
+    encodings, names, images = [], [], {}
+    row = header["rows"] if header else 0
+    for key in added:
+        try:
+            encoding = enroll_encoding(found[key]["file"])
+        except:
+            logger.error("Unable to read %s, skipping it", found[key]["file"])
+            continue
+
+        if encoding is None:
+            logger.info("No face found in %s", found[key]["file"])
+            images[key] = dict(found[key], rows=[row, 0])
+            continue
+
+        encodings.append(encoding)
+        names.append(found[key]["name"])
+        images[key] = dict(found[key], rows=[row, 1])
+        row += 1
+
+    index_file = join(gallery_dir, "index.ivf.npz")
+    if not removed and header is not None and header["version"] == gallery_version:
+        #Just new photos - append them and slot them into the existing index
+        if encodings:
+            old_rows, old_generation = header["rows"], header.get("generation", 0)
+            header = append_gallery(gallery_dir, dict(header, images=enrolled), encodings, names, images)
+            if os.path.exists(index_file):
+                try:
+                    with np.load(index_file) as saved:
+                        current = "generation" in saved.files and int(saved["generation"]) == old_generation and int(saved["gallery_rows"]) == old_rows
+                        index = ivf_index(saved["centroids"], saved["order"], saved["offsets"])
+                    if current:
+                        gallery = open_gallery(gallery_dir)
+                        index.extend(gallery["encodings"], old_rows).save(index_file, header["rows"], header["generation"])
+                except:
+                    logger.error("Unable to update the ivf index at %s, it will be rebuilt when next loaded", index_file)
+
+        #No new rows, but remember photos without a face (so they are not tried again) and any that moved
+        elif images or enrolled != header.get("images", {}):
+            header = dict(header, images=dict(enrolled, **images))
+            write_gallery_header(gallery_dir, header)
+
+    else:
+        #Something came out (or this is an old layout), so write the gallery out again from the rows we are keeping. Nothing is encoded twice
+        keep_rows, kept, next_row = [], {}, 0
+        if gallery is not None:
+            keep = np.ones(header["rows"], dtype=bool)
+            for key in removed:
+                (start, count) = enrolled.pop(key)["rows"]
+                keep[start:start + count] = False
+            keep_rows = np.flatnonzero(keep)
+
+            #Rows are about to move, so point each photo at its new rows
+            new_row = np.cumsum(keep) - 1
+            for (key, image) in enrolled.items():
+                (start, count) = image["rows"]
+                kept[key] = dict(image, rows=[int(new_row[start]) if count else 0, count])
+            next_row = len(keep_rows)
+
+        for image in images.values():
+            image["rows"] = [next_row, image["rows"][1]]
+            next_row += image["rows"][1]
+        kept.update(images)
+
+        old_encodings = np.asarray(gallery["encodings"])[keep_rows] if gallery is not None else np.empty((0, 128), dtype=np.float32)
+        old_names = [gallery["names"][i] for i in np.asarray(gallery["name_ids"])[keep_rows]] if gallery is not None else []
+        all_encodings = np.concatenate((old_encodings, np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1))) if encodings else old_encodings
+        header = save_gallery(gallery_dir, all_encodings, old_names + names, kept, header.get("generation", 0) if header else 0, header.get("dims", 128) if header else 128)
+
+        #Row numbers changed, so any saved index has to be built again (done the next time the gallery is loaded)
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+    logger.info("Enrolled %s new photos (%s encoded, %s removed) into %s", len(added), len(encodings), len(removed), gallery_dir)
+    print(f'Encoded {len(encodings)} new photos and removed {len(removed)} from {gallery_dir}. It now holds {header["rows"] if header else 0} encodings for {len(header["names"]) if header else 0} people')
+
+#Class for an IVF (inverted file) index over the gallery. Encodings are grouped under coarse k-means centroids and a face is only compared against the nprobe closest groups
+class ivf_index:
+    """
+        :param centroids:       Coarse cluster centres (lists x 128) (required)
+        :param order:           Gallery row numbers sorted by the cluster they belong to (required)
+        :param offsets:         Where each cluster starts/ends in order (lists + 1) (required)
+        :param nprobe:          Number of clusters to search per face - the recall/latency knob
+
+        Example:    matcher.index = open_ivf_index("encodings.pickle.ivf.npz", matcher.encodings, 0, 8)
+    """
+    def __init__(self, centroids, order, offsets, nprobe=8):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.nprobe = max(1, min(int(nprobe), len(self.centroids)))
+
+    #Function to return the sorted gallery rows that any of the queries should be compared against
+    def candidates(self, queries):
+        #Distance ranking only needs squared distances, and the query norm is the same for every centroid
+        centroid_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        scores = centroid_norms[None, :] - 2.0 * (queries @ self.centroids.T)
+        probed = np.unique(np.argpartition(scores, self.nprobe - 1, axis=1)[:, :self.nprobe])
+
+        rows = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in probed]
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    #Function to save the index so it only has to be built once (generation ties it to one version of a gallery directory)
+    def save(self, index_file, gallery_rows, generation=-1):
+        with open(index_file, "wb") as file:
+            np.savez(file, centroids=self.centroids, order=self.order, offsets=self.offsets, gallery_rows=np.int64(gallery_rows), generation=np.int64(generation))
+
+    #Function to add gallery rows from start onwards without re-running k-means (each new row goes under its closest centroid)
+    def extend(self, encodings, start):
+        labels = np.empty(start, dtype=np.int64)
+        for i in range(len(self.centroids)):
+            labels[self.order[self.offsets[i]:self.offsets[i + 1]]] = i
+        labels = np.concatenate((labels, nearest_centroid(encodings[start:], self.centroids)))
+
+        order = np.argsort(labels, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=len(self.centroids)))))
+        return ivf_index(self.centroids, order, offsets, self.nprobe)
+
+#Function to assign each encoding to its closest centroid (done in chunks so large galleries do not blow up memory)
+def nearest_centroid(encodings, centroids, chunk=8192):
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(encodings), dtype=np.int64)
+
+    for start in range(0, len(encodings), chunk):
+        block = np.asarray(encodings[start:start + chunk], dtype=np.float32)
+        labels[start:start + chunk] = (centroid_norms[None, :] - 2.0 * (block @ centroids.T)).argmin(axis=1)
+
+    return labels
+
+#Function to build an ivf index over the gallery with a few rounds of k-means on a sample of the encodings
+def build_ivf_index(encodings, lists=0, nprobe=8, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+
+    #Roughly sqrt(n) clusters keeps both the centroid scan and each list scan small
+    if lists <= 0:
+        lists = int(math.sqrt(len(encodings)))
+    lists = max(1, min(lists, len(encodings)))
+
+    #Train on a sample so building stays quick on very large galleries
+    sample_size = min(len(encodings), lists * 64)
+    sample = np.asarray(encodings[np.sort(rng.choice(len(encodings), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, lists, replace=False)].copy()
+
+    for i in range(iterations):
+        labels = nearest_centroid(sample, centroids)
+        counts = np.bincount(labels, minlength=lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+
+        #Keep the old centre for any cluster that ended up empty
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+    #Bucket every gallery row under its closest centroid
+    labels = nearest_centroid(encodings, centroids)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=lists))))
+
+    return ivf_index(centroids, order, offsets, nprobe)
+
+#Function to load the saved ivf index for the gallery, or build (and save) a new one if it is missing or out of date
+def open_ivf_index(index_file, encodings, lists=0, nprobe=8, gallery_file=None, generation=None):
+    try:
+        with np.load(index_file) as saved:
+            #An index for another generation of the gallery directory (or older than the pickle) was built for a different set of faces
+            if generation is not None:
+                stale = "generation" not in saved.files or int(saved["generation"]) != generation
+            else:
+                stale = gallery_file is not None and getmtime(gallery_file) > getmtime(index_file)
+
+            if not stale and int(saved["gallery_rows"]) == len(encodings) and (lists <= 0 or lists == len(saved["centroids"])):
+                logger.info("Loaded ivf index with %s lists from %s", len(saved["centroids"]), index_file)
+                return ivf_index(saved["centroids"], saved["order"], saved["offsets"], nprobe)
+
+        logger.info("Saved ivf index does not match the gallery, rebuilding it")
+    except FileNotFoundError:
+        logger.info("No ivf index found at %s, building one", index_file)
+
+    started = time.perf_counter()
+    index = build_ivf_index(encodings, lists, nprobe)
+    logger.info("Built ivf index with %s lists in %.2f seconds", len(index.centroids), time.perf_counter() - started)
+
+    try:
+        index.save(index_file, len(encodings), -1 if generation is None else generation)
+    except:
+        logger.error("Unable to save the ivf index to %s", index_file)
+
+    return index
+
+#Class to stream sampled frames out of a video file. Frames we do not want are only grabbed (never retrieved/converted) so they stay cheap
+class frame_stream:
+    """
+        :param process_file:    The video file to pull frames out of (required)
+        :param mode:            Sampling policy - 'nth' (every Nth frame), 'fps' (N frames per second of video) or 'keyframes' (only key frames)
+        :param rate:            N for the 'nth' and 'fps' policies (ignored for 'keyframes')
+        :param max_frames:      Most frames to decode from the clip (0 for no limit). Longer clips get a wider step so we still cover the whole clip
+
+        Example:    for index, frame in frame_stream("alert1.mp4", "fps", 2, 60):
+    """
+    def __init__(self, process_file, mode="fps", rate=2, max_frames=60):
+        self.process_file = process_file
+        self.mode = mode
+        self.rate = rate
+        self.max_frames = max_frames
+
+        #Counters so the caller can see how much work the clip cost
+        self.decoded = 0
+        self.skipped = 0
+        self.open_time = 0.0    #Seconds spent opening the clip
+
+    #Function to work out how many frames to step over between samples for the nth and fps policies
+    def frame_step(self, capture):
+        if self.mode == "nth":
+            step = max(1, int(self.rate))
+
+        else:
+            #Fall back to 1 frame a second when we are in keyframe mode but the backend cannot tell us about key frames
+            rate = self.rate if self.mode == "fps" else 1
+            source_fps = capture.get(cv2.CAP_PROP_FPS) or 30
+            step = max(1, int(round(source_fps / max(rate, 0.001))))
+
+        #Widen the step on long clips so we spread our frame budget across the whole clip instead of stopping early
+        total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if self.max_frames > 0 and total_frames > 0 and total_frames / step > self.max_frames:
+            step = int(math.ceil(total_frames / self.max_frames))
+            logger.debug("Widened sampling step to %s frames to stay within %s frames for %s", step, self.max_frames, self.process_file)
+
+        return step
+
+    #Function to yield (frame index, frame) for each sampled frame in the clip
+    def __iter__(self):
+        started = time.perf_counter()
+        capture = cv2.VideoCapture(self.process_file)
+        self.open_time = time.perf_counter() - started
+
+        if not capture.isOpened():
+            logger.error("Unable to open video file: %s", self.process_file)
+            return
+
+        #Key frame flag is only available on newer OpenCV builds using the FFmpeg backend
+        keyframe_prop = getattr(cv2, "CAP_PROP_LRF_HAS_KEY_FRAME", None)
+        use_keyframes = self.mode == "keyframes" and keyframe_prop is not None
+        step = self.frame_step(capture)
+        index = -1
+
+        try:
+            #Grab every frame (cheap), but only retrieve the ones our policy wants
+            while capture.grab():
+                index += 1
+
+                #Stop once the frame budget is used up - grabbing the rest of the clip still runs the codec
+                if self.max_frames > 0 and self.decoded >= self.max_frames:
+                    break
+
+                if use_keyframes:
+                    wanted = bool(capture.get(keyframe_prop))
+
+                    #The first frame of a clip is always a key frame, so if the backend says otherwise it does not support the flag
+                    if index == 0 and not wanted:
+                        logger.debug("Key frame flag not supported for %s, sampling by time instead", self.process_file)
+                        use_keyframes = False
+                        wanted = True
+
+                else:
+                    wanted = index % step == 0
+
+                if not wanted:
+                    self.skipped += 1
+                    continue
+
+                ret, frame = capture.retrieve()
+                if not ret:
+                    self.skipped += 1
+                    continue
+
+                self.decoded += 1
+                yield index, frame
+
+        finally:
+            capture.release()
+            logger.info("Decoded %s frames and skipped %s frames from %s", self.decoded, self.skipped, self.process_file)
+
+#Function to merge overlapping boxes (x, y, w, h) with non-maximum suppression so the same face found by two cascades is only kept once (bigger boxes win)
+def merge_boxes(boxes, overlap=0.3):
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    if len(boxes) < 2:
+        return [tuple(int(v) for v in box) for box in boxes]
+
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    areas = boxes[:, 2] * boxes[:, 3]
+    remaining = np.argsort(-areas, kind="stable")
+    kept = []
+
+    while len(remaining) > 0:
+        best, others = remaining[0], remaining[1:]
+        kept.append(best)
+
+        #Intersection over union between the box we kept and everything left
+        width = np.maximum(0, np.minimum(x2[best], x2[others]) - np.maximum(x1[best], x1[others]))
+        height = np.maximum(0, np.minimum(y2[best], y2[others]) - np.maximum(y1[best], y1[others]))
+        intersection = width * height
+        iou = intersection / (areas[best] + areas[others] - intersection)
+
+        remaining = others[iou <= overlap]
+
+    #Hand the boxes back in reading order so results are the same from run to run
+    return sorted((tuple(int(v) for v in boxes[i]) for i in kept), key=lambda box: (box[1], box[0]))
+
+#Function to get the grayscale frame to run detection on. Shrinking before the colour conversion means both steps work on fewer pixels. Returns the frame and the scale back to full resolution
+def detection_gray(frame, width=0):
+    height, frame_width = frame.shape[:2]
+
+    if width <= 0 or frame_width <= width:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 1.0
+
+    scale = frame_width / float(width)
+    small = cv2.resize(frame, (width, int(round(height / scale))), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), scale
+
+#Class to hold a frame (or a crop of one) with its colour conversions, so each colour space is only worked out once and shared by every stage that needs it
+class frame_buffers:
+    """
+        :param bgr:     The frame as it came out of the clip (required)
+        :param offset:  Where the frame sits in the whole frame (x, y), when it is an ROI crop
+
+        Example:    buffers = frame_buffers(frame); gray, scale = buffers.detection(640); rgb = buffers.rgb()
+    """
+    def __init__(self, bgr, offset=(0, 0)):
+        self.bgr = bgr
+        self.offset = offset
+        self.converted = {}     #cv2 colour conversion code -> converted image
+        self.detect = None      #(width, gray, scale) used for detection
+
+    #Function to get the frame in another colour space, converting it the first time only
+    def convert(self, code):
+        image = self.converted.get(code)
+        if image is None:
+            image = self.converted[code] = cv2.cvtColor(self.bgr, code)
+        return image
+
+    def gray(self):
+        return self.convert(cv2.COLOR_BGR2GRAY)
+
+    def rgb(self):
+        return self.convert(cv2.COLOR_BGR2RGB)
+
+    #Function to get the (possibly shrunk) grayscale frame detection runs on, and the scale back to full resolution
+    def detection(self, width=0):
+        if self.detect is None or self.detect[0] != width:
+            if width <= 0 or self.bgr.shape[1] <= width:
+                self.detect = (width, self.gray(), 1.0)
+            else:
+                self.detect = (width,) + detection_gray(self.bgr, width)
+
+        return self.detect[1], self.detect[2]
+
+    #Function to get the grayscale pixels under a whole frame box, out of the detection frame if we have one
+    def region_gray(self, box):
+        gray, scale = (self.detect[1], self.detect[2]) if self.detect is not None else (self.gray(), 1.0)
+        (x, y, w, h) = box
+        left, top = int((x - self.offset[0]) / scale), int((y - self.offset[1]) / scale)
+        return gray[max(0, top):max(0, top) + max(1, int(h / scale)), max(0, left):max(0, left) + max(1, int(w / scale))]
+
+#Function to turn full resolution motion regions into the areas of a shrunk frame worth running a detector over (the whole frame when there are no regions)
+def search_regions(regions, frame_shape, scale=1.0, minimum=120):
+    #Without motion regions just look at the whole frame
+    frame_region = (0, 0, frame_shape[1], frame_shape[0])
+    if regions:
+        regions = [(int(x / scale), int(y / scale), int(math.ceil(w / scale)), int(math.ceil(h / scale))) for (x, y, w, h) in regions]
+        regions = [pad_region(region, frame_shape, minimum=minimum) for region in regions]
+    else:
+        regions = [frame_region]
+
+    #Lots of little regions cost more in detector setup than they save, so fall back to one box around all of them (or the whole frame if that is most of it)
+    if len(regions) > 4:
+        left, top = min(r[0] for r in regions), min(r[1] for r in regions)
+        right, bottom = max(r[0] + r[2] for r in regions), max(r[1] + r[3] for r in regions)
+        regions = [(left, top, right - left, bottom - top)]
+    if sum(r[2] * r[3] for r in regions) > 0.6 * frame_shape[0] * frame_shape[1]:
+        regions = [frame_region]
+
+    return regions
+
+#Class to run cascades on a shared thread pool. OpenCV lets go of the GIL inside detectMultiScale, so the cascades for a frame (and frames from clips being worked on at the same time) really do run in parallel. Each thread loads its own copy of a cascade as they are not safe to share
+class detector_pool:
+    """
+        :param cascade_files:   Cascade name -> xml file (required)
+        :param threads:         Threads to run cascades on (1 runs them one after another on the calling thread)
+
+        Example:    boxes = detectors.detect(gray, ["haar_frontal", "haar_profile"], [(0, 0, 640, 360)], (60, 60))
+    """
+    def __init__(self, cascade_files, threads=4):
+        self.cascade_files = dict(cascade_files)
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="blue_ss_detect") if threads > 1 else None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latency = {}   #Cascade name -> [count, total seconds, max seconds]
+
+    #Function to get this thread's copy of a cascade
+    def cascade(self, name):
+        cascades = getattr(self.local, "cascades", None)
+        if cascades is None:
+            cascades = self.local.cascades = {}
+        if name not in cascades:
+            cascades[name] = cv2.CascadeClassifier(self.cascade_files[name])
+        return cascades[name]
+
+    #Function to run one cascade over one area and record how long it took
+    def run(self, name, area, min_size):
+        started = time.perf_counter()
+        found = self.cascade(name).detectMultiScale(area, scaleFactor=1.1, minNeighbors=5, minSize=min_size, flags=cv2.CASCADE_SCALE_IMAGE)
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            latency = self.latency.setdefault(name, [0, 0.0, 0.0])
+            latency[0] += 1
+            latency[1] += elapsed
+            latency[2] = max(latency[2], elapsed)
+
+        return list(found)
+
+    #Function to run every cascade over every region of a grayscale frame. Boxes come back in (region, cascade) order whatever order the threads finish in, so results are the same from run to run
+    def detect(self, gray, names, regions, min_size):
+        jobs = [(name, region) for region in regions for name in names]
+        if self.executor is None:
+            results = [self.run(name, gray[ry:ry + rh, rx:rx + rw], min_size) for (name, (rx, ry, rw, rh)) in jobs]
+        else:
+            futures = [self.executor.submit(self.run, name, gray[ry:ry + rh, rx:rx + rw], min_size) for (name, (rx, ry, rw, rh)) in jobs]
+            results = [future.result() for future in futures]
+
+        #Move the boxes back into whole frame coordinates
+        boxes = []
+        for ((name, (rx, ry, rw, rh)), found) in zip(jobs, results):
+            boxes.extend((x + rx, y + ry, w, h) for (x, y, w, h) in found)
+        return boxes
+
+    #Function to report the latency of each cascade (ms)
+    def stats(self):
+        with self.lock:
+            return {name: {"count": count, "mean_ms": round(total * 1000 / count, 3), "max_ms": round(longest * 1000, 3)} for (name, (count, total, longest)) in self.latency.items()}
+
+#Function to run a frontal and profile cascade over a grayscale frame and return the merged face boxes (x, y, w, h). Regions and the returned boxes are in full resolution coordinates, scale is how much gray was shrunk by. With a pool, frontal and profile are cascade names and run side by side on the pool
+def detect_faces(gray, frontal, profile, regions=None, scale=1.0, pool=None):
+    #Faces need to be 60px at full resolution, but never ask the cascades for less than their 24px training window
+    min_face = max(24, int(round(60 / scale)))
+    regions = search_regions(regions, gray.shape, scale, 2 * min_face)
+
+    if pool is not None:
+        boxes = pool.detect(gray, [frontal, profile], regions, (min_face, min_face))
+
+    else:
+        boxes = []
+        for (rx, ry, rw, rh) in regions:
+            area = gray[ry:ry + rh, rx:rx + rw]
+
+            faces = frontal.detectMultiScale(area, scaleFactor=1.1, minNeighbors=5, minSize=(min_face, min_face), flags=cv2.CASCADE_SCALE_IMAGE)
+            profile_faces = profile.detectMultiScale(area, scaleFactor=1.1, minNeighbors=5, minSize=(min_face, min_face), flags=cv2.CASCADE_SCALE_IMAGE)
+
+            #Move the boxes back into whole frame coordinates
+            boxes.extend((x + rx, y + ry, w, h) for (x, y, w, h) in list(faces) + list(profile_faces))
+
+    #Merge at detection resolution, then blow the boxes back up to full resolution for encoding and annotation
+    return [(int(round(x * scale)), int(round(y * scale)), int(round(w * scale)), int(round(h * scale))) for (x, y, w, h) in merge_boxes(boxes)]
+
+#Class to find people (whole bodies) with OpenCV's HOG people detector, for when nobody shows the camera their face. Frames are shrunk as they are decoded and detected on as one batch at the end of the clip
+class person_detector:
+    """
+        :param width:       Width frames are shrunk to before detection
+        :param min_weight:  Lowest HOG score that still counts as a person
+
+        Example:    found = people.detect_batch([people.prepare(index, frame, regions)])
+    """
+    def __init__(self, width=640, min_weight=0.5):
+        self.width = width
+        self.min_weight = min_weight
+        self.hog = cv2.HOGDescriptor()
+        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        self.window = (64, 128)     #Size of the default people detector window (w, h)
+
+        #Counters so the benchmark can report throughput
+        self.frames = 0
+        self.seconds = 0.0
+
+    #Function to shrink a frame (and its full resolution motion regions) ready for detection. Returns (index, small frame, regions, scale)
+    def prepare(self, index, frame, regions=None):
+        height, width = frame.shape[:2]
+        if self.width <= 0 or width <= self.width:
+            return (index, frame, search_regions(regions, frame.shape, 1.0, 2 * self.window[1]), 1.0)
+
+        scale = width / float(self.width)
+        small = cv2.resize(frame, (self.width, int(round(height / scale))), interpolation=cv2.INTER_AREA)
+        return (index, small, search_regions(regions, small.shape, scale, 2 * self.window[1]), scale)
+
+    #Function to find the people in one prepared frame. Returns [(box, weight)] in the shrunk frame's coordinates
+    def detect(self, small, regions):
+        scores = {}
+        for (rx, ry, rw, rh) in regions:
+            #The HOG window has to fit inside the area we look at
+            if rw < self.window[0] or rh < self.window[1]:
+                continue
+
+            found, weights = self.hog.detectMultiScale(small[ry:ry + rh, rx:rx + rw], winStride=(8, 8), padding=(8, 8), scale=1.05)
+            for (box, score) in zip(found, np.asarray(weights).reshape(-1)):
+                if score >= self.min_weight:
+                    (x, y, w, h) = (int(v) for v in box)
+                    box = (x + rx, y + ry, w, h)
+                    scores[box] = max(float(score), scores.get(box, 0.0))
+
+        #Same person found in two overlapping regions or at two scales only counts once
+        return [(box, scores[box]) for box in merge_boxes(list(scores), 0.5)]
+
+    #Function to run detection over a batch of prepared frames. Returns [(index, small frame, box, weight)] for every person found
+    def detect_batch(self, batch):
+        started = time.perf_counter()
+        found = []
+        for (index, small, regions, scale) in batch:
+            for (box, weight) in self.detect(small, regions):
+                found.append((index, small, box, weight))
+
+        self.frames += len(batch)
+        self.seconds += time.perf_counter() - started
+        return found
+
+    #Function to report how fast detection is running
+    def stats(self):
+        return {"frames": self.frames, "seconds": round(self.seconds, 3), "frames_per_sec": round(self.frames / self.seconds, 2) if self.seconds else 0.0}
+
+#Function to encode the given face boxes. Passing them in as known_face_locations stops dlib from running its own detector over the whole frame again
+def encode_faces(rgb, boxes):
+    if not boxes:
+        return []
+
+    #face_recognition wants (top, right, bottom, left). Its dlib models are shared, so only one clip encodes at a time
+    locations = [(y, x + w, y + h, x) for (x, y, w, h) in boxes]
+    with encode_lock:
+        return face_recognition.face_encodings(rgb, known_face_locations=locations)
+
+#Class to write snapshots on a background thread. Images go onto a bounded queue and get encoded (jpg/webp/png) and written by the writer thread, so detection never waits on the disk
+class snapshot_writer:
+    """
+        :param image_format:    'jpg', 'webp' or 'png'
+        :param quality:         Quality for jpg/webp (0-100)
+        :param mode:            'full' for the whole frame, 'face' for a thumbnail of the face or 'both'
+        :param max_width:       Shrink full frames to this width before saving (0 to keep full resolution)
+        :param queue_size:      Most snapshots waiting to be written. When it is full new snapshots are dropped rather than making the caller wait
+
+        Example:    path = writer.submit(datetime.now().strftime(save_location), snapshot, (x, y, w, h))
+    """
+    def __init__(self, image_format="jpg", quality=90, mode="full", max_width=0, queue_size=32):
+        self.image_format = image_format if image_format in ("jpg", "webp", "png") else "jpg"
+        self.quality = quality
+        self.mode = mode
+        self.max_width = max_width
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+
+        #Counters so we can see how the writer is keeping up
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.max_depth = 0
+
+        if self.image_format == "jpg":
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        elif self.image_format == "webp":
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+        else:
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    #Function to queue a snapshot (path without the extension). Returns the path the main image will end up at, or None if it was dropped
+    def submit(self, path_base, image, box=None):
+        path = f"{path_base}.{self.image_format}" if self.mode != "face" or box is None else f"{path_base}_thumb.{self.image_format}"
+
+        try:
+            self.queue.put_nowait((path_base, image, box))
+        except queue.Full:
+            self.dropped += 1
+            logger.error("Snapshot queue is full, dropped snapshot %s", path)
+            return None
+
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return path
+
+    #Function for the writer thread - encode and write whatever is on the queue
+    def run(self):
+        while True:
+            path_base, image, box = self.queue.get()
+
+            try:
+                if self.mode in ("full", "both") or box is None:
+                    self.write(f"{path_base}.{self.image_format}", self.shrink(image))
+
+                if self.mode in ("face", "both") and box is not None:
+                    self.write(f"{path_base}_thumb.{self.image_format}", self.thumbnail(image, box))
+            except:
+                self.failed += 1
+                logger.error("Unable to write snapshot %s", path_base)
+
+            self.queue.task_done()
+
+    #Function to encode an image and write it out
+    def write(self, path, image):
+        ret, encoded = cv2.imencode("." + self.image_format, image, self.params)
+        if not ret:
+            raise ValueError(f"Unable to encode {path}")
+
+        with open(path, "wb") as file:
+            file.write(encoded.tobytes())
+
+        self.written += 1
+        self.bytes_written += len(encoded)
+
+    #Function to shrink a full frame down to max_width
+    def shrink(self, image):
+        height, width = image.shape[:2]
+        if self.max_width <= 0 or width <= self.max_width:
+            return image
+
+        return cv2.resize(image, (self.max_width, int(height * self.max_width / width)), interpolation=cv2.INTER_AREA)
+
+    #Function to cut a padded thumbnail of the face out of the frame
+    def thumbnail(self, image, box):
+        (x, y, w, h) = box
+        height, width = image.shape[:2]
+        pad = int(max(w, h) * 0.5)
+        return image[max(0, y - pad):min(height, y + h + pad), max(0, x - pad):min(width, x + w + pad)]
+
+    #Function to wait for everything on the queue to be written, then log the counters
+    def flush(self):
+        self.queue.join()
+        logger.info("Snapshot writer: %s", json.dumps(self.stats()))
+
+    #Function to get the writer counters
+    def stats(self):
+        return {"submitted": self.submitted, "written": self.written, "dropped": self.dropped, "failed": self.failed, "bytes_written": self.bytes_written, "queue_depth": self.queue.qsize(), "max_depth": self.max_depth}
+
+#Class to coalesce detections into one alert email. Everything from a clip (or from a short time window across clips) goes into one message with the snapshots attached, sent to every contact over a single SMTP session
+class alert_aggregator:
+    """
+        :param window:          Seconds to keep collecting after the first detection before sending (0 to send at the end of every clip)
+        :param thumb_width:     Width the attached snapshots are shrunk to
+        :param max_images:      Most snapshots attached to one email (the rest are still listed in the text)
+
+        Example:    alerts.add(camera, result, snapshot) ... alerts.clip_done()
+    """
+    def __init__(self, window=0, thumb_width=480, max_images=6):
+        self.window = window
+        self.thumb_width = thumb_width
+        self.max_images = max_images
+        self.pending = []   #Detections waiting to go out - (camera, result, jpeg bytes)
+        self.timer = None
+        self.lock = threading.Lock()
+
+    #Function to add a detection (the annotated snapshot is shrunk and encoded straight away so we do not hold on to full frames)
+    def add(self, camera, result, snapshot):
+        height, width = snapshot.shape[:2]
+        if width > self.thumb_width:
+            snapshot = cv2.resize(snapshot, (self.thumb_width, int(height * self.thumb_width / width)), interpolation=cv2.INTER_AREA)
+
+        ret, encoded = cv2.imencode(".jpg", snapshot, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        with self.lock:
+            self.pending.append((camera, result, encoded.tobytes() if ret else None))
+
+    #Function to call when a clip is finished - send now, or start the window timer if we are collecting across clips
+    def clip_done(self):
+        if self.window <= 0:
+            self.flush()
+            return
+
+        with self.lock:
+            if self.pending and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    #Function to send whatever has been collected
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if pending:
+            try:
+                self.send(pending)
+            except:
+                logger.error("Error sending alert email!!!")
+
+    #Function to build the one multipart message for all the detections
+    def build(self, pending):
+        message = EmailMessage()
+        message["Subject"] = f"BlueSS Alert! - {len(pending)} detection(s) on {', '.join(sorted(set(camera for (camera, result, image) in pending)))}"
+        message["From"] = alert_email
+
+        lines = ["BlueSS Alert! - A Face Or Body Was Detected!", ""]
+        for (camera, result, image) in pending:
+            lines.append(f'{result.get("time", datetime.now()):%Y-%m-%d %H:%M:%S} - camera {camera} - {result["name"]} (confidence {result.get("confidence", 0.0):.2f}, seen in {result.get("hits", 1)} frames)')
+        if len(pending) > self.max_images:
+            lines.extend(["", f"Only the first {self.max_images} snapshots are attached"])
+        message.set_content("\n".join(lines) + "\n")
+
+        for (i, (camera, result, image)) in enumerate(pending[:self.max_images]):
+            if image is not None:
+                message.add_attachment(image, maintype="image", subtype="jpeg", filename=f'{camera}_{i + 1}_{result["name"]}.jpg')
+
+        return message
+
+    #Function to log in once and deliver the message to every contact
+    def send(self, pending):
+        message = self.build(pending)
+        started = time.perf_counter()
+
+        #Create a secure SSL context
+        context = ssl.create_default_context()
+
+        #Try to log in to server
+        with smtplib.SMTP(smtp_server, int(smtp_port)) as server:
+            server.ehlo()
+            server.starttls(context=context)
+            server.ehlo()
+            server.login(alert_email, alert_password)
+            connected = time.perf_counter()
+
+            #Iterate through the list of contacts from the config file and send them the email
+            for email in alert_list:
+                try:
+                    sent = time.perf_counter()
+                    del message["To"]
+                    message["To"] = email
+                    server.send_message(message, alert_email, [email])
+                    logger.info("Sent notification to: %s (%.0f ms)", email, (time.perf_counter() - sent) * 1000)
+                except:
+                    logger.error("Error sending alert email!!!")
+
+        logger.info("Alert with %s detection(s) delivered to %s contact(s) - connect/login %.0f ms, total %.0f ms", len(pending), len(alert_list), (connected - started) * 1000, (time.perf_counter() - started) * 1000)
+
+#Class for a persistent SQLite cache of clip results, keyed by a hash of the clip contents plus the pipeline and gallery versions, so re-triggered or duplicate clips are not processed twice
+class result_cache:
+    """
+        :param cache_file:      SQLite file to keep results in (required)
+        :param pipeline:        Anything describing the pipeline settings - a change means old results no longer count (required)
+        :param gallery:         Anything describing the gallery version (required)
+        :param max_entries:     Most clips to keep results for
+        :param max_age_days:    Oldest result to keep
+
+        Example:    key = cache.key("alert1.mp4"); results = cache.get(key)
+    """
+    def __init__(self, cache_file, pipeline, gallery, max_entries=1000, max_age_days=7):
+        self.pipeline = pipeline
+        self.version = hashlib.sha256(f"{pipeline}|{gallery}".encode()).hexdigest()[:16]
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        #Batch workers share the file, so wait on locks rather than failing
+        self.connection = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created REAL, results TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER)")
+        self.connection.commit()
+
+    #Function to switch to a new gallery version (after a reload). Old results stay in the file until they age out
+    def rekey(self, gallery):
+        self.version = hashlib.sha256(f"{self.pipeline}|{gallery}".encode()).hexdigest()[:16]
+
+    #Function to work out the cache key for a clip - the hash of its contents plus the pipeline/gallery version
+    def key(self, process_file):
+        digest = hashlib.sha256()
+        with open(process_file, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+
+        return f"{digest.hexdigest()}:{self.version}"
+
+    #Function to look up the results for a clip. Returns None on a miss
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT results, created FROM results WHERE key = ?", (key,)).fetchone()
+            hit = row is not None and time.time() - row[1] <= self.max_age
+
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.connection.execute("INSERT INTO stats (name, count) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET count = count + 1", ("hits" if hit else "misses",))
+            self.connection.commit()
+
+        return json.loads(row[0]) if hit else None
+
+    #Function to store the results for a clip and evict anything too old or over the size limit
+    def put(self, key, results):
+        now = time.time()
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO results (key, created, results) VALUES (?, ?, ?)", (key, now, json.dumps(results)))
+            self.connection.execute("DELETE FROM results WHERE created < ?", (now - self.max_age,))
+            self.connection.execute("DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY created DESC LIMIT ?)", (self.max_entries,))
+            self.connection.commit()
+
+    #Function to get the hit/miss counters (this process, and all time from the cache file)
+    def stats(self):
+        with self.lock:
+            totals = dict(self.connection.execute("SELECT name, count FROM stats").fetchall())
+            entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "total_hits": totals.get("hits", 0), "total_misses": totals.get("misses", 0), "entries": entries}
+
+#Function to pull the camera name out of a BlueIris clip file name (BlueIris names clips '<camera>.<date>_<time>.mp4' by default)
+def camera_name(process_file):
+    return basename(process_file).split(".")[0].lower()
+
+#Function to get a setting for a camera, using the per camera override from the config if there is one
+def camera_setting(setting, camera, default):
+    value = camera_settings.get((setting, camera))
+    if value is None:
+        return default
+
+    try:
+        return type(default)(value)
+    except:
+        logger.error("Invalid value for %s on camera %s: %s", setting, camera, value)
+        return default
+
+#Class for a camera's region of interest. Frames are cropped to the bounding box of the ROI and anything outside its shapes is blacked out, so the motion gate and detectors only ever see the part of the scene we care about
+class roi_mask:
+    """
+        :param spec:    Shapes from the config - 'x,y x,y ...' per shape (2 points for a rectangle, 3 or more for a polygon), more shapes split with '|'. If every value is 1 or less they are fractions of the frame (required)
+
+        Example:    area, (offset_x, offset_y) = roi_mask("0,0.4 1,1").apply(frame)
+    """
+    def __init__(self, spec):
+        self.shapes = []
+        for shape in spec.split("|"):
+            points = [tuple(float(value) for value in point.split(",")) for point in shape.split()]
+            if len(points) == 2:
+                (x1, y1), (x2, y2) = points
+                points = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+            if len(points) < 3 or any(len(point) != 2 for point in points):
+                raise ValueError(f"ROI shapes need 2 (rectangle) or more (polygon) x,y points: {shape}")
+            self.shapes.append(points)
+
+        self.fractional = all(value <= 1.0 for shape in self.shapes for point in shape for value in point)
+        self.rectangle = len(self.shapes) == 1 and len(spec.split()) == 2     #A single rectangle only needs cropping, not masking
+
+        #Worked out for the first frame and reused while the frame size stays the same
+        self.frame_shape = None
+        self.box = None
+        self.mask = None
+
+    #Function to work out the crop box and mask for a frame size
+    def layout(self, frame_shape):
+        height, width = frame_shape[:2]
+        scale_x, scale_y = (width, height) if self.fractional else (1, 1)
+        polygons = [np.array([(min(max(int(round(x * scale_x)), 0), width), min(max(int(round(y * scale_y)), 0), height)) for (x, y) in shape], dtype=np.int32) for shape in self.shapes]
+
+        (x, y, w, h) = cv2.boundingRect(np.concatenate(polygons))
+        w, h = min(w, width - x), min(h, height - y)
+        if w <= 0 or h <= 0:
+            raise ValueError("ROI does not cover any of the frame")
+
+        self.frame_shape = frame_shape[:2]
+        self.box = (x, y, w, h)
+        self.mask = None
+        if not self.rectangle:
+            self.mask = np.zeros((h, w), dtype=np.uint8)
+            cv2.fillPoly(self.mask, [polygon - (x, y) for polygon in polygons], 255)
+
+    #Function to crop (and mask) a frame down to the ROI. Returns the area and the (x, y) offset to add to anything found in it
+    def apply(self, frame):
+        if frame.shape[:2] != self.frame_shape:
+            self.layout(frame.shape)
+
+        (x, y, w, h) = self.box
+        area = frame[y:y + h, x:x + w]
+        if self.mask is not None:
+            area = cv2.bitwise_and(area, area, mask=self.mask)
+
+        return area, (x, y)
+
+#Class for a cheap motion gate that sits in front of the detectors. It keeps a running background model of a small grayscale copy of the frame and only lets frames with enough changed pixels through
+class motion_gate:
+    """
+        :param width:               Width the frame is shrunk to before comparing it with the background
+        :param pixel_threshold:     How much a pixel has to change (0-255) to count as moving
+        :param min_area:            Fraction of the frame that has to be moving for the frame to pass
+        :param learning_rate:       How quickly the background model soaks up changes (0-1)
+
+        Example:    moving, regions = motion_gate(160, 25, 0.002).check(frame)
+    """
+    def __init__(self, width=160, pixel_threshold=25, min_area=0.002, learning_rate=0.1):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_area = min_area
+        self.learning_rate = learning_rate
+        self.background = None
+
+        #Counters so we can see how much work the gate saved
+        self.passed = 0
+        self.rejected = 0
+
+    #Function to check a frame for movement. Returns if it moved, and the moving regions (x, y, w, h) in full frame coordinates
+    def check(self, frame):
+        height, width = frame.shape[:2]
+        scale = width / float(self.width) if width > self.width else 1.0
+        small = cv2.resize(frame, (int(width / scale), int(height / scale)), interpolation=cv2.INTER_AREA) if scale > 1.0 else frame
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        #Nothing to compare the first frame with, so let it through and use it as the background
+        if self.background is None:
+            self.background = small.astype(np.float32)
+            self.passed += 1
+            return True, [(0, 0, width, height)]
+
+        difference = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(small, self.background, self.learning_rate)
+        mask = cv2.threshold(difference, self.pixel_threshold, 255, cv2.THRESH_BINARY)[1]
+
+        if cv2.countNonZero(mask) < self.min_area * mask.size:
+            self.rejected += 1
+            return False, []
+
+        #Join nearby moving pixels into blobs and scale their boxes back up to the full frame
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        regions = []
+        for contour in contours:
+            (x, y, w, h) = cv2.boundingRect(contour)
+            regions.append((int(x * scale), int(y * scale), int(math.ceil(w * scale)), int(math.ceil(h * scale))))
+
+        self.passed += 1
+        return True, regions
+
+#Function to grow motion regions so a face on the edge of the movement is still inside them, clamped to the frame
+def pad_region(region, frame_shape, padding=0.25, minimum=120):
+    (x, y, w, h) = region
+    height, width = frame_shape[:2]
+    pad_w = max(int(w * padding), (minimum - w) // 2, 0)
+    pad_h = max(int(h * padding), (minimum - h) // 2, 0)
+
+    left, top = max(0, x - pad_w), max(0, y - pad_h)
+    right, bottom = min(width, x + w + pad_w), min(height, y + h + pad_h)
+    return (left, top, right - left, bottom - top)
+
+#Function to score how likely a new box is the same face as a track's last box. IOU when they overlap enough, otherwise a smaller score for a nearby box of a similar size (people move a fair bit between sampled frames)
+def box_similarity(track_box, box, iou_threshold=0.3):
+    (tx, ty, tw, th), (x, y, w, h) = track_box, box
+
+    width = max(0, min(tx + tw, x + w) - max(tx, x))
+    height = max(0, min(ty + th, y + h) - max(ty, y))
+    intersection = width * height
+    iou = intersection / float(tw * th + w * h - intersection)
+    if iou >= iou_threshold:
+        return iou
+
+    distance = math.hypot((tx + tw / 2.0) - (x + w / 2.0), (ty + th / 2.0) - (y + h / 2.0)) / max(tw, th)
+    size_ratio = (w * h) / float(tw * th)
+    if distance < 1.0 and 0.5 <= size_ratio <= 2.0:
+        return iou_threshold * (1.0 - distance)
+
+    return 0.0
+
+#Class for a lightweight IOU/centroid tracker that groups face boxes across sampled frames into tracks, keeping only the best few crops of each face
+class face_tracker:
+    """
+        :param iou_threshold:   How much a box has to overlap a track to join it
+        :param max_gap:         How many sampled frames a track can go without a detection before it is closed
+        :param best_crops:      How many of the best (biggest and sharpest) crops to keep per track
+        :param padding:         How much room to leave around each face crop so the encoder has the whole face
+
+        Example:    tracker.update(index, frame, boxes, buffers)
+    """
+    def __init__(self, iou_threshold=0.3, max_gap=3, best_crops=3, padding=0.3):
+        self.iou_threshold = iou_threshold
+        self.max_gap = max_gap
+        self.best_crops = best_crops
+        self.padding = padding
+        self.tracks = []    #Every track in the clip - id, box, first/last frame index, hits and crops
+        self.samples = 0    #Sampled frames seen so far
+
+    #Function to add a frame's boxes to the tracks (greedy best-score-first assignment, anything left over starts a new track). Buffers lets us reuse the frame's grayscale copy for scoring crops
+    def update(self, index, frame, boxes, buffers=None):
+        self.samples += 1
+        active = [track for track in self.tracks if self.samples - track["last_sample"] <= self.max_gap]
+
+        pairs = []
+        for (t, track) in enumerate(active):
+            for (b, box) in enumerate(boxes):
+                score = box_similarity(track["box"], box, self.iou_threshold)
+                if score > 0:
+                    pairs.append((score, t, b))
+
+        used_tracks, used_boxes = set(), set()
+        for (score, t, b) in sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2])):
+            if t in used_tracks or b in used_boxes:
+                continue
+
+            used_tracks.add(t)
+            used_boxes.add(b)
+            self.extend(active[t], index, frame, boxes[b], buffers)
+
+        for (b, box) in enumerate(boxes):
+            if b not in used_boxes:
+                track = {"id": len(self.tracks) + 1, "box": box, "first": index, "last": index, "last_sample": self.samples, "hits": 0, "crops": []}
+                self.tracks.append(track)
+                self.extend(track, index, frame, box, buffers)
+
+    #Function to add a detection to a track and keep its crop if it is one of the best so far
+    def extend(self, track, index, frame, box, buffers=None):
+        (x, y, w, h) = box
+        track["box"] = box
+        track["last"] = index
+        track["last_sample"] = self.samples
+        track["hits"] += 1
+
+        #Padded crop around the face, plus where the face sits inside it
+        height, width = frame.shape[:2]
+        pad_w, pad_h = int(w * self.padding), int(h * self.padding)
+        left, top = max(0, x - pad_w), max(0, y - pad_h)
+        right, bottom = min(width, x + w + pad_w), min(height, y + h + pad_h)
+        crop = frame[top:bottom, left:right]
+
+        #Bigger and sharper faces encode better
+        face_gray = buffers.region_gray(box) if buffers is not None else cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+        quality = w * h * (1.0 + cv2.Laplacian(face_gray, cv2.CV_64F).var())
+
+        if len(track["crops"]) < self.best_crops or quality > track["crops"][-1]["quality"]:
+            track["crops"].append({"quality": quality, "index": index, "frame": frame, "box": box, "crop": frame_buffers(crop), "crop_box": (x - left, y - top, w, h)})
+            track["crops"].sort(key=lambda item: -item["quality"])
+            del track["crops"][self.best_crops:]
+
+#Function to vote on a track's identity from the match results of its crops. Returns (name, distance, confidence)
+def vote_identity(matches):
+    known = [match for match in matches if match[0] != "Unknown"]
+    if not known:
+        return ("Unknown", min([match[1] for match in matches] or [float("inf")]), 0.0)
+
+    #Most votes wins, ties go to the closest match
+    tally = {}
+    for (name, distance, confidence) in known:
+        votes, best, total = tally.get(name, (0, float("inf"), 0.0))
+        tally[name] = (votes + 1, min(best, distance), total + confidence)
+
+    name = min(tally, key=lambda key: (-tally[key][0], tally[key][1]))
+    votes, distance, total = tally[name]
+
+    #Agreement across crops times how sure each crop was
+    return (name, distance, (votes / float(len(matches))) * (total / votes))
+
+#Class to time each stage of a clip (count, total and max per stage). Only perf_counter and a dict update per call, so it is always on
+class stage_timer:
+    """
+        Example:    with timer("detect"): boxes = detect_faces(...)
+    """
+    def __init__(self):
+        self.stages = {}    #Stage name -> [count, total seconds, max seconds]
+        self.running = []   #Stages we are inside of right now (stages can nest, e.g. lbp inside identify)
+        self.started = time.perf_counter()
+
+    #Function to name the stage the next 'with' block belongs to
+    def __call__(self, name):
+        self.running.append((name, 0.0))
+        return self
+
+    def __enter__(self):
+        name, _ = self.running[-1]
+        self.running[-1] = (name, time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        name, started = self.running.pop()
+        self.add(name, time.perf_counter() - started)
+        return False
+
+    #Function to add a timing (seconds) to a stage
+    def add(self, name, elapsed):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [1, elapsed, elapsed]
+        else:
+            stage[0] += 1
+            stage[1] += elapsed
+            if elapsed > stage[2]:
+                stage[2] = elapsed
+
+    #Function to time every item pulled out of an iterable (the frames out of a frame_stream)
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - started)
+                return
+            self.add(name, time.perf_counter() - started)
+            yield item
+
+    #Function to hand back the stages in milliseconds, ready to log
+    def summary(self):
+        stages = {name: {"count": count, "total_ms": round(total * 1000, 3), "max_ms": round(longest * 1000, 3)} for (name, (count, total, longest)) in self.stages.items()}
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 3), "stages": stages}
+
 #Class to do all the processing work on the files
 class check_faces:
     """
@@ -170,11 +1989,85 @@ class check_faces:
         except:
             pass
 
+        #Pick up any people enrolled since the last clip
+        reload_gallery()
+
+        #Pull the camera name out of the clip so we can use any per camera settings
+        self.camera = camera_name(args.file)
+        self.detections = []    #Name of every person (track) we found in the clip
+        self.results = []       #One result per track
+        self.summary = {"tracks": 0, "best_name": None, "confidence": 0.0, "snapshot": None}
+        self.stream = None
+        self.person_batch = []  #Shrunk frames kept back for person detection
+        self.timer = stage_timer()
+
+        #Only look inside the camera's region of interest if it has one
+        self.roi = None
+        roi = camera_setting("roi", self.camera, "")
+        if roi:
+            try:
+                self.roi = roi_mask(roi)
+            except:
+                logger.error("Invalid roi for camera %s, looking at the whole frame: %s", self.camera, roi)
+
+        #Profile the whole clip if the config asks for it
+        profiler = None
+        if profile_dir:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            self.process(args.file)
+
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                try:
+                    profile_file = join(profile_dir, f"{self.camera}_{datetime.now():%Y%m%d-%H%M%S%f}.prof")
+                    profiler.dump_stats(profile_file)
+                    logger.info("Profile for %s written to %s", args.file, profile_file)
+                except:
+                    logger.error("Unable to write profile to %s", profile_dir)
+
+            #One line per clip with where the time went
+            logger.info("Clip timings for %s: %s", args.file, json.dumps(self.timer.summary()))
+
+    #Function to run the clip through the cache and the detectors
+    def process(self, process_file):
+        #If we have already seen this exact clip, hand back what we found last time without decoding anything
+        cache_key = None
+        if cache is not None:
+            try:
+                with self.timer("cache_lookup"):
+                    cache_key = cache.key(process_file)
+                    cached = cache.get(cache_key)
+            except:
+                logger.error("Unable to check the result cache for %s", process_file)
+                cached = None
+
+            if cached is not None:
+                self.detections, self.results, self.summary = cached["detections"], cached["results"], cached["summary"]
+                logger.info("Cache hit for %s, skipping processing: %s (%s)", process_file, json.dumps(self.summary), json.dumps(cache.stats()))
+                return
+
         #Run the Haar processing to look for faces (then LBP if it doesnt find a match on detected face)
-        self.lbp_processing(self, args.file)
+        self.haar_processing(process_file)
 
         #Run the human processing function so we can look for human-forms
-        self.human_processing(self, args.file)
+        with self.timer("human"):
+            self.human_processing(process_file)
+
+        #Save and alert on everyone we found
+        self.report_tracks(process_file)
+
+        #Remember what we found in case the same clip comes through again
+        if cache_key is not None:
+            try:
+                with self.timer("cache_store"):
+                    results = [{key: value for (key, value) in result.items() if key not in ("frame", "time")} for result in self.results]
+                    cache.put(cache_key, {"detections": self.detections, "results": results, "summary": self.summary})
+            except:
+                logger.error("Unable to store results in the cache for %s", process_file)
 
     #If the script/class quits, close the connection cleanly
     def __del__(self):
@@ -182,182 +2075,403 @@ class check_faces:
 
     #Function to use Haar against the video file. This usally works better so we use it first. If it doesnt get a face, we skip over to the LBP function
     def haar_processing(self, process_file):
-        #Read the incoming video file and change colors to for processing
-        ret, frame = cv2.VideoCapture(process_file).read()
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = haar_frontal.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60), flags=cv2.CASCADE_SCALE_IMAGE)
-        profile_faces = haar_profile.detectMultiScale(gray,scaleFactor=1.1,minNeighbors=5,minSize=(60, 60),flags=cv2.CASCADE_SCALE_IMAGE)
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        #Define the facial embeddings for face in input
-        encodings = face_recognition.face_encodings(rgb)
-        names = []
-
-        #Loop through the facial embeddings incase we have multiple embeddings for multiple fcaes
-        for encoding in encodings:
-            #Compare encodings with encodings in data["encodings"]
-            #Matches contain array with boolean values and True for the embeddings it matches closely and False for rest
-            matches = face_recognition.compare_faces(dlib["encodings"],encoding)
-
-            #set name to "unknown" if no encoding matches
-            name = "Unknown"
-
-            #Check to see if we have found a match
-            if True in matches:
-                #Find positions at which we get True and store them
-                matchedIdxs = [i for (i, b) in enumerate(matches) if b]
-                counts = {}
-
-                #Loop through the matched indexes and maintain a count for each recognized face face
-                for i in matchedIdxs:
-                    #Check the names at respective indexes we stored in matchedIdxs
-                    name = dlib["names"][i]
-
-                    #Increase count for the name we got
-                    counts[name] = counts.get(name, 0) + 1
-
-                #Set name which has highest count
-                name = max(counts, key=counts.get)
-
-            #Update the list of names
-            names.append(name)
-
-            #Loop through the recognized faces (frontal)
-            for ((x, y, w, h), name) in zip(faces, names):
-                if name == "Unknown":
-                    #Call the LBP function to see if we get a match there. If we don't, call it unamed
-                    name = self.lbp_processing(self, frame)
-
-                #Rescale the face coordinates and draw the predicted face name on the image
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 1)
-                cv2.putText(frame, name, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 2)
-                cv2.putText(frame, str(datetime.now()),(10,30), cv2.FONT_HERSHEY_SIMPLEX, .5,(0,0,0),1,cv2.LINE_AA)
-
-                #Save the image for processing later
-                cv2.imwrite(datetime.now().strftime(save_location), frame)
-                logger.info("Face was detected!! %s", name)
-
-                #Send an alert since we detected a face in the video
-                self.send_alert(self, frame)
-
-            #Loop through the recognized faces (profile)
-            for ((a, b, c, d), name) in zip(profile_faces, names):
-                if name == "Unknown":
-                    #Call the LBP function to see if we get a match there. If we don't, call it unamed
-                    name = self.lbp_processing(self, frame)
-
-                #Rescale the face coordinates and draw the predicted face name on the image
-                cv2.rectangle(frame, (a, b), (a + c, b + d), (0, 0, 255), 1)
-                cv2.putText(frame, name, (a, b), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 2)
-                cv2.putText(frame, str(datetime.now()),(10,30), cv2.FONT_HERSHEY_SIMPLEX, .5,(0,0,0),1,cv2.LINE_AA)
-
-                #Save the image for processing later
-                cv2.imwrite(datetime.now().strftime(save_location), frame)
-                logger.info("Face was detected!! %s", name)
-
-                #Send an alert since we detected a face in the video
-                self.send_alert(self, frame)
-        
-    #Function to use LBP against the face snapshots captured to see if we can pull out a match (Use only the images that have faces detected so we do not have to process the whole file again)
-    def lbp_processing(self, image):
-        #Set name
-        name = "Unknown"
-
-        #Convert image to Greyscale for haarcascade
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = lbp_frontal.detectMultiScale(gray,scaleFactor=1.1,minNeighbors=5,minSize=(60, 60),flags=cv2.CASCADE_SCALE_IMAGE)
-        profile_faces = lbp_profile.detectMultiScale(gray,scaleFactor=1.1,minNeighbors=5,minSize=(60, 60),flags=cv2.CASCADE_SCALE_IMAGE)
-        
-        #Define the facial embeddings for face in input
-        encodings = face_recognition.face_encodings(rgb)
-        names = []
-
-        #Loop through the facial embeddings incase we have multiple faces detected
-        for encoding in encodings:
-            #Compare encodings with encodings in data["encodings"]
-            #Matches contain array with boolean values and True for the embeddings it matches closely and False for rest
-            matches = face_recognition.compare_faces(dlib["encodings"], encoding)
-
-            #Check to see if we have found a match
-            if True in matches:
-                #Find positions at which we get True and store them
-                matchedIdxs = [i for (i, b) in enumerate(matches) if b]
-                counts = {}
-                #Loop through the matched indexes and maintain a count for each recognized face face
-                for i in matchedIdxs:
-                    #Check the names at respective indexes we stored in matchedIdxs
-                    name = dlib["names"][i]
-
-                    #Increase count for the name we got
-                    counts[name] = counts.get(name, 0) + 1
-
-                    #Set name which has highest count
-                    name = max(counts, key=counts.get)
-        
-                #Update the list of names
-                names.append(name)
-
-                #Loop through the recognized faces (frontal)
-                for ((x, y, w, h), name) in zip(faces, names):
-                    #If still an unknown name, pass so we continue
-                    if name == "Unknown":
-                        pass
-
-                #Loop through the recognized faces (profile)
-                for ((a, b, c, d), name) in zip(profile_faces, names):
-                    #If still an unknown name, pass so we continue
-                    if name == "Unknown":
-                        pass
-
-        #Return the name if one was found
-        return name
-
-    #Function to check the video for any human-forms
+        #Stream sampled frames across the whole clip (people rarely show up in the very first frame)
+        self.stream = frame_stream(process_file, sample_mode, sample_rate, max_frames)
+
+        #Motion gate in front of the detectors so static background frames are thrown away cheaply
+        self.gate = motion_gate(motion_width, camera_setting("motion_pixel_threshold", self.camera, motion_pixel_threshold), camera_setting("motion_min_area", self.camera, motion_min_area), motion_learning_rate)
+
+        #Group detections of the same person across frames so we encode and alert per person, not per frame
+        self.tracker = face_tracker(track_iou, track_max_gap, track_best_crops)
+
+        #Opening the clip happens on the first frame, so it lands in 'decode' too (frame_stream also keeps it on its own)
+        moving_frames = 0
+        for index, frame in self.timer.iterate("decode", self.stream):
+            #Crop to the region of interest before anything else touches the frame
+            area, (offset_x, offset_y) = frame, (0, 0)
+            if self.roi is not None:
+                with self.timer("roi"):
+                    area, (offset_x, offset_y) = self.roi.apply(frame)
+
+            regions = None
+            if motion_gate_enabled:
+                with self.timer("motion"):
+                    moving, regions = self.gate.check(area)
+                if not moving:
+                    continue
+
+            #Faces are tracked (and later annotated) on the whole frame, so move the boxes back out of the ROI
+            buffers = frame_buffers(area, (offset_x, offset_y))
+            boxes = [(x + offset_x, y + offset_y, w, h) for (x, y, w, h) in self.haar_frame(buffers, regions)]
+            with self.timer("track"):
+                self.tracker.update(index, frame, boxes, buffers)
+
+            #Keep a shrunk copy back in case nobody in the clip shows us their face (people are annotated on this ROI copy)
+            moving_frames += 1
+            if people is not None and len(self.person_batch) < person_frames and (moving_frames - 1) % person_every == 0:
+                with self.timer("person_prepare"):
+                    self.person_batch.append(people.prepare(index, area, regions))
+
+        self.timer.add("open", self.stream.open_time)
+
+        if motion_gate_enabled:
+            logger.info("Motion gate rejected %s of %s frames from %s", self.gate.rejected, self.gate.rejected + self.gate.passed, process_file)
+
+        #Put a name to each track
+        self.identify_tracks()
+
+    #Function to run the Haar cascades against a single frame from the clip (only inside the moving regions if we have them) and return the face boxes
+    def haar_frame(self, buffers, regions=None):
+        #Change colors of the frame for processing (detection runs on a shrunk copy if the camera is set up for it)
+        with self.timer("convert"):
+            gray, scale = buffers.detection(camera_setting("detect_width", self.camera, detect_width))
+        with self.timer("detect"):
+            return detect_faces(gray, "haar_frontal", "haar_profile", regions, scale, detectors)
+
+    #Function to encode the best crops of every track, match them against the gallery and vote on who each track is
+    def identify_tracks(self):
+        for track in self.tracker.tracks:
+            encodings = []
+            for crop in track["crops"]:
+                with self.timer("convert"):
+                    rgb = crop["crop"].rgb()
+                with self.timer("encode"):
+                    encodings.extend(encode_faces(rgb, [crop["crop_box"]]))
+
+            with self.timer("match"):
+                name, distance, confidence = vote_identity(matcher.match(encodings))
+            best = track["crops"][0]
+
+            #Call the LBP function on the crops of anyone Haar could not name to see if we get a match there. If we don't, call it unamed
+            if name == "Unknown":
+                with self.timer("lbp"):
+                    for crop in track["crops"]:
+                        match = self.lbp_processing(crop["crop"])
+                        if match[0] != "Unknown":
+                            name, distance, confidence = match
+                            break
+
+            self.results.append({"track": track["id"], "name": name, "distance": distance, "confidence": confidence, "hits": track["hits"], "first": track["first"], "last": track["last"], "frame": best["frame"], "box": best["box"]})
+
+    #Function to save a snapshot and send an alert for each track, and log one summary line for the clip
+    def report_tracks(self, process_file):
+        for result in self.results:
+            #Draw the predicted face name on a copy of the best frame for this track
+            with self.timer("snapshot"):
+                (x, y, w, h) = result["box"]
+                snapshot = result["frame"].copy()
+                cv2.rectangle(snapshot, (x, y), (x + w, y + h), (0, 0, 255), 1)
+                cv2.putText(snapshot, result["name"], (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 2)
+                cv2.putText(snapshot, str(datetime.now()),(10,30), cv2.FONT_HERSHEY_SIMPLEX, .5,(0,0,0),1,cv2.LINE_AA)
+
+                #Save the image for processing later (written in the background)
+                result["snapshot"] = writer.submit(datetime.now().strftime(save_location), snapshot, (x, y, w, h))
+            result["time"] = datetime.now()
+            logger.info("Face was detected!! %s (track %s, %s frames, confidence %.2f)", result["name"], result["track"], result["hits"], result["confidence"])
+            self.detections.append(result["name"])
+
+            #Add it to the alert for this clip
+            with self.timer("alert_add"):
+                alerts.add(self.camera, result, snapshot)
+
+        #Send one alert for everything we found in the clip (SMTP happens here unless alerts are batched over a window)
+        with self.timer("alert_send"):
+            self.send_alert()
+
+        #Best result is the most confident named person, or failing that the track we saw the most
+        if self.results:
+            best = max(self.results, key=lambda result: (result["name"] not in ("Unknown", "Person"), result["name"] != "Person", result["confidence"], result["hits"]))
+            self.summary = {"tracks": len(self.results), "best_name": best["name"], "confidence": round(best["confidence"], 3), "snapshot": best["snapshot"]}
+
+        logger.info("Clip summary for %s: %s", process_file, json.dumps(self.summary))
+
+    #Function to use LBP against the padded face crop Haar found to see if we can pull out a match (only the crop, so we do not have to process the whole frame again)
+    def lbp_processing(self, crop):
+
+        #The crop is small already, so run LBP on it at full resolution. Its grayscale and rgb copies are shared with the Haar encoding step
+        faces = detect_faces(crop.gray(), "lbp_frontal", "lbp_profile", pool=detectors)
+
+        #Encode the boxes LBP found and match them all against the gallery in one go
+        encodings = encode_faces(crop.rgb(), faces)
+
+        #Take the first face that we were able to put a name to, so its distance and confidence go with it
+        for match in matcher.match(encodings):
+            if match[0] != "Unknown":
+                return match
+
+        return ("Unknown", float("inf"), 0.0)
+
+    #Function to check the video for any human-forms. Only runs when no face was found, as a face track already covers that person
     def human_processing(self, process_file):
-        print()
+        if people is None or self.results or not self.person_batch:
+            self.person_batch = []
+            return
+
+        frames = len(self.person_batch)
+        found = people.detect_batch(self.person_batch)
+        self.person_batch = []
+        logger.info("Person detection found %s people in %s frames from %s (%s)", len(found), frames, process_file, json.dumps(people.stats()))
+        if not found:
+            return
+
+        #One result for the clip, from the strongest detection
+        (index, small, box, weight) = max(found, key=lambda person: person[3])
+        indexes = sorted(set(person[0] for person in found))
+        self.results.append({"track": "person", "name": "Person", "distance": None, "confidence": min(1.0, weight), "hits": len(indexes), "first": indexes[0], "last": indexes[-1], "frame": small, "box": box})
+
+    #Function to send out email alerts in the case that a face or body was found (the aggregator sends one email per clip, or per alert window)
+    def send_alert(self):
+        alerts.clip_done()
+
+#Class to run as a long running daemon. The models and gallery are loaded once, then clips are picked up from the BlueIris clips directory or handed to us over a local socket
+class facial_daemon:
+    """
+        :param watch_dir:   BlueIris clips directory to watch for new mp4 files (optional if clips are only sent over the socket)
+        :param port:        Local port to listen on for clips from the thin client
+        :param settle:      Seconds a clip has to stop growing before we treat it as complete
+        :param interval:    Seconds between checks of the clips directory and pending clips
 
-    #Function to send out email alerts in the case that a face or body was found
-    def send_alert(self, image):
-        #Create message to send
-        message_beginning = """\
-            BlueSS Alert! - A Face Or Body Was Detected!
-            """
+        Example:    python3 blue_ss_facial.py -d -w D:\BlueIris\Alerts
+    """
+    def __init__(self, watch_dir=None, port=8765, settle=2.0, interval=1.0):
+        self.watch_dir = watch_dir
+        self.port = port
+        self.settle = settle
+        self.interval = interval
+
+        self.queue = queue.Queue()      #Clips that are complete and waiting to be processed
+        self.pending = {}               #Clips we know about that may still be being written - path: [not_before, last_size, stable_since]
+        self.seen = set()               #Clips in the watch directory we have already picked up
+        self.lock = threading.Lock()
+
+        #Anything already sitting in the directory when we start is old news (batch mode is for backlogs)
+        if self.watch_dir:
+            self.seen = set(self.list_clips())
+
+    #Function to list the clips in the watch directory
+    def list_clips(self):
+        try:
+            return [join(self.watch_dir, name) for name in os.listdir(self.watch_dir) if name.lower().endswith(".mp4")]
+        except:
+            logger.error("Unable to list clips in %s", self.watch_dir)
+            return []
 
-        message = f'{message_beginning}A Face or Body was detected at {datetime.now()}\n'
+    #Function to add a clip to the pending list (delay is the old '-t' wait, which now just means 'not before')
+    def submit(self, path, delay=0):
+        with self.lock:
+            if path not in self.pending:
+                self.pending[path] = [time.time() + (delay or 0), -1, None]
+                logger.info("Clip submitted: %s", path)
 
-        #Create a secure SSL context
-        context = ssl.create_default_context()
+        return self.queue.qsize() + len(self.pending)
 
-        #Try to log in to server
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            server.login(alert_email, alert_password)
+    #Function to check if a clip has finished being written (size has not changed for a while and nobody has it locked)
+    def clip_ready(self, path, entry, now):
+        if now < entry[0]:
+            return False
 
-            #Iterate through the list of contacts from the config file and send them the email
-            for email in alert_list:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+
+        if size != entry[1] or size == 0:
+            entry[1] = size
+            entry[2] = now
+            return False
+
+        if now - entry[2] < self.settle:
+            return False
+
+        #BlueIris keeps clips locked on Windows while it is still writing them
+        try:
+            with open(path, "ab"):
+                pass
+        except OSError:
+            return False
+
+        return True
+
+    #Function to look for new clips and move complete ones onto the work queue
+    def watch(self):
+        while True:
+            if self.watch_dir:
+                clips = set(self.list_clips())
+                for path in clips - self.seen:
+                    self.submit(path)
+                self.seen = clips
+
+            now = time.time()
+            with self.lock:
+                for path, entry in list(self.pending.items()):
+                    if self.clip_ready(path, entry, now):
+                        del self.pending[path]
+                        self.queue.put(path)
+
+            time.sleep(self.interval)
+
+    #Function to process clips off the work queue with the already loaded models (one of these runs per daemon worker)
+    def work(self):
+        while True:
+            path = self.queue.get()
+            started = time.perf_counter()
+
+            try:
+                check_faces(argparse.Namespace(file=path, time=0))
+                logger.info("Processed %s in %.2f seconds", path, time.perf_counter() - started)
+                logger.info("Snapshot writer: %s", json.dumps(writer.stats()))
+                logger.info("Cascade latency: %s", json.dumps(detectors.stats()))
+            except:
+                logger.error("Error processing clip %s", path)
+
+            self.queue.task_done()
+
+    #Function to start the watcher and worker threads and then serve the local socket forever
+    def run(self):
+        daemon = self
+
+        #Each connection sends one JSON line {"file": <path>, "time": <seconds>} and gets the queue depth back
+        class submit_handler(socketserver.StreamRequestHandler):
+            def handle(self):
                 try:
-                    server.sendmail(alert_email, email, message)
-                    logger.info("Sent notification to: %s", email)
+                    request = json.loads(self.rfile.readline().decode())
+                    depth = daemon.submit(os.path.abspath(request["file"]), request.get("time", 0))
+                    self.wfile.write((json.dumps({"queued": True, "depth": depth}) + "\n").encode())
                 except:
-                    logger.error("Error sending alert email!!!")
+                    logger.error("Bad request on the daemon socket")
+                    self.wfile.write((json.dumps({"queued": False}) + "\n").encode())
+
+        threading.Thread(target=self.watch, daemon=True).start()
+        for worker in range(daemon_workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        with socketserver.ThreadingTCPServer(("127.0.0.1", self.port), submit_handler) as server:
+            logger.info("Daemon listening on 127.0.0.1:%s and watching %s", self.port, self.watch_dir)
+            server.serve_forever()
+
+#Function for the thin client - hand a clip to a running daemon. Returns False if no daemon is listening
+def submit_clip(path, delay=0, port=8765):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as connection:
+            connection.sendall((json.dumps({"file": os.path.abspath(path), "time": delay or 0}) + "\n").encode())
+            reply = json.loads(connection.makefile().readline())
+    except (OSError, ValueError):
+        return False
+
+    return reply.get("queued", False)
+
+#Function to work out a percentile (nearest rank) from a list of numbers
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)]
+
+#Function run once in each batch worker process so the cascades and gallery are only loaded once per worker
+def batch_init(threads):
+    parse_config(threads)
+
+    #The workers already split the cores between them, so OpenCV should not start its own threads on top
+    cv2.setNumThreads(1)
+
+#Function run in a batch worker for each clip
+def batch_worker(path):
+    started = time.perf_counter()
 
+    try:
+        faces = check_faces(argparse.Namespace(file=path, time=0))
+
+        #Make sure the snapshots are on disk and the alert is out before the pool can shut this worker down
+        writer.flush()
+        alerts.flush()
+        return {"file": path, "ok": True, "seconds": time.perf_counter() - started, "frames": faces.stream.decoded if faces.stream else 0, "faces": faces.detections}
+    except:
+        logger.error("Error processing clip %s", path)
+        return {"file": path, "ok": False, "seconds": time.perf_counter() - started, "frames": 0, "faces": []}
+
+#Function to process a backlog of clips (a directory or a glob) over a pool of worker processes, printing results as they finish
+def batch_process(pattern, workers=0):
+    clips = sorted(glob.glob(join(pattern, "*.mp4") if isdir(pattern) else pattern))
+    if not clips:
+        print(f"No clips found for {pattern}")
         return
 
+    workers = min(workers or multiprocessing.cpu_count(), len(clips))
+    threads = max(1, multiprocessing.cpu_count() // workers)   #Split the cores between the workers so their detector threads do not oversubscribe the machine
+    latencies = []
+    failed = 0
+    started = time.perf_counter()
+
+    logger.info("Batch processing %s clips over %s workers (%s detector threads each)", len(clips), workers, threads)
+    with multiprocessing.Pool(workers, initializer=batch_init, initargs=(threads,)) as pool:
+        #Results come back in the order they finish, not the order they went in
+        for result in pool.imap_unordered(batch_worker, clips):
+            latencies.append(result["seconds"])
+            failed += 0 if result["ok"] else 1
+
+            status = "ok" if result["ok"] else "FAILED"
+            print(f'[{len(latencies)}/{len(clips)}] {result["file"]} - {status} - {result["seconds"]:.2f}s - {result["frames"]} frames - faces: {", ".join(result["faces"]) or "none"}')
+
+    elapsed = time.perf_counter() - started
+    summary = f"Processed {len(clips)} clips ({failed} failed) in {elapsed:.1f}s - {len(clips) / elapsed:.2f} clips/sec - latency p50 {percentile(latencies, 50):.2f}s p90 {percentile(latencies, 90):.2f}s p99 {percentile(latencies, 99):.2f}s max {max(latencies):.2f}s"
+    logger.info(summary)
+    print(summary)
+
 ### THE THING ###
 if __name__ == '__main__':
     #Set up and parse through the arguments in order to determine what we need to do
     parser = argparse.ArgumentParser()
     required_args = parser.add_argument_group('required arguments')
     required_args.add_argument("-t", dest="time", required=False, type=int) #Time to wait before tunning the script
-    required_args.add_argument("-f", dest="file", required=True, type=str) #File that we are going to process
+    required_args.add_argument("-f", dest="file", required=False, type=str) #File that we are going to process
+    parser.add_argument("--convert", dest="convert", nargs=2, metavar=("PICKLE", "GALLERY_DIR"), required=False) #Convert a pickled dlib file into a gallery directory and exit
+    parser.add_argument("--enroll", dest="enroll", nargs=2, metavar=("PEOPLE_DIR", "GALLERY_DIR"), required=False) #Encode new photos (a folder per person) into a gallery directory and exit
+    parser.add_argument("-d", dest="daemon", action="store_true") #Run as a long running daemon instead of processing one file
+    parser.add_argument("-w", dest="watch", required=False, type=str) #BlueIris clips directory for the daemon to watch
+    parser.add_argument("-p", dest="port", required=False, type=int, default=8765) #Local port the daemon listens on
+    parser.add_argument("--local", dest="local", action="store_true") #Always process the file in this process, even if a daemon is running
+    parser.add_argument("-b", dest="batch", required=False, type=str) #Directory or glob of clips to batch process
+    parser.add_argument("-j", dest="workers", required=False, type=int, default=0) #Number of batch worker processes (defaults to the number of cores)
 
     args = parser.parse_args()
 
+    #One-shot conversion of the old pickle format, no config or video needed
+    if args.convert:
+        convert_gallery(args.convert[0], args.convert[1])
+        quit()
+
+    #Enroll new photos into the gallery - running daemons pick the change up before their next clip
+    if args.enroll:
+        enroll_gallery(args.enroll[0], args.enroll[1])
+        quit()
+
+    #Batch mode - work through a backlog of clips on every core
+    if args.batch:
+        batch_process(args.batch, args.workers)
+        quit()
+
+    #Daemon mode - load everything once and keep going
+    if args.daemon:
+        parse_config()
+        facial_daemon(args.watch, args.port).run()
+        quit()
+
+    if not args.file:
+        parser.error("the following arguments are required: -f")
+
+    #Thin client - if a daemon is running, let it do the work with its warm models
+    if not args.local and submit_clip(args.file, args.time, args.port):
+        logger.info("Handed %s to the daemon", args.file)
+        quit()
+
     #Parse through config file to get the info we need
     parse_config()
 
     #Start processing the given fike
-    check_faces(args)
\ No newline at end of file
+    check_faces(args)
+
+    #Wait for the snapshots to hit the disk and any windowed alert to go out before we exit
+    writer.flush()
+    alerts.flush()
\ No newline at end of file
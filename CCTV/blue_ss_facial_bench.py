@@ -0,0 +1,382 @@
+"""
+TITLE: BlueSS Facial Benchmark
+BY:
+    Some Guy they call Scooter
+    Common Sense Cyber Group
+
+Created: 10/18/2026
+Updated: 10/18/2026
+
+Version: 1.0.0
+
+License: MIT
+
+Purpose:
+    -The purpose of this script is to measure how fast the different pieces of BlueSS Facial run so we can compare settings, commits and machines
+    -Everything runs against synthetic data so no real gallery, camera or email server is needed
+
+Considerations:
+    -Synthetic galleries are clustered like real dlib encodings (about 0.3 apart for the same person and about 0.9 apart for different people)
+    -Synthetic frames are built by pasting face crops (from '-i <dir of face images>') onto a static background, so we know where every face is
+    -Cascades come from the config file if one is given with '-c', otherwise from the copies in 'FACE FINDER.zip' next to this script
+    -The pipeline benchmark writes a synthetic mp4 and runs it through check_faces (the same path as a real clip), including sending the alert to a local SMTP stand-in (no TLS or login)
+    -The scale and pipeline benchmarks need a directory of face crop images ('-i')
+    -Results are printed as JSON so they can be saved and compared later
+
+Arguments:
+    --The process for invoking this script: 'python blue_ss_facial_bench.py -b <benchmark>'
+        -This would be: 'python3 blue_ss_facial_bench.py -b index -s 1000,10000,100000'
+        -Or: 'python3 blue_ss_facial_bench.py -b scale -i faces/ -r 1920x1080 -w 0,1280,960,640,480'
+        -Or: 'python3 blue_ss_facial_bench.py -b pipeline -i faces/ -r 1280x720 -t 10 -o results.json'
+
+"""
+
+### IMPORT LIBRARIES ###
+import argparse     #https://docs.python.org/3.8/library/argparse.html - Used for parsing through arguments handed to the script
+import json     #https://docs.python.org/3.8/library/json.html - Used for printing the results in a machine readable way
+import time     #https://docs.python.org/3.8/library/time.html - Used for timing the benchmarks
+import glob     #https://docs.python.org/3.8/library/glob.html - Used for finding face crop images
+from os.path import join, dirname    #https://docs.python.org/3.8/library/os.path.html - Used for building file paths
+import tempfile     #https://docs.python.org/3.8/library/tempfile.html - Used for the synthetic video and snapshots
+import shutil   #https://docs.python.org/3.8/library/shutil.html - Used for cleaning up the temp directory
+import zipfile  #https://docs.python.org/3.8/library/zipfile.html - Used for pulling the bundled cascades out of FACE FINDER.zip
+import platform     #https://docs.python.org/3.8/library/platform.html - Used for recording which machine the results came from
+import subprocess   #https://docs.python.org/3.8/library/subprocess.html - Used for recording which commit the results came from
+import multiprocessing  #https://docs.python.org/3.8/library/multiprocessing.html - Used for recording the core count
+import threading    #https://docs.python.org/3.8/library/threading.html - Used for the SMTP stand-in
+import socketserver #https://docs.python.org/3.8/library/socketserver.html - Used for the SMTP stand-in
+import smtplib  #https://docs.python.org/3.8/library/smtplib.html - Used for sending the alert to the SMTP stand-in
+import numpy as np  #https://numpy.org/doc/stable/ - Used for generating synthetic data
+import cv2      #https://pypi.org/project/opencv-python/ - cv2 library for image processing (imported as the package so cv2.data is available)
+import face_recognition #https://pypi.org/project/face-recognition/ - Used for the encoding stage
+import blue_ss_facial   #BlueSS Facial - Used to point the pipeline at the bench settings and run check_faces
+from blue_ss_facial import face_matcher, build_ivf_index, detection_gray, detect_faces, snapshot_writer, alert_aggregator, person_detector, detector_pool, save_gallery   #BlueSS Facial - The pieces we are benchmarking
+
+### DEFINE VARIABLES ###
+project_root = dirname(__file__)   #Defines the root directory the script is currently in
+
+### CLASSES AND FUNCTIONS ###
+#Function to create a synthetic gallery of encodings that are clustered by person like real dlib encodings
+def synthetic_gallery(size, per_person=20, seed=0):
+    rng = np.random.default_rng(seed)
+    people = max(1, size // per_person)
+
+    #Centres ~0.9 apart, and each encoding ~0.3 from its centre
+    centres = rng.normal(0, 0.056, (people, 128)).astype(np.float32)
+    labels = rng.integers(0, people, size)
+    encodings = centres[labels] + rng.normal(0, 0.027, (size, 128)).astype(np.float32)
+    names = [f"person_{label}" for label in labels]
+
+    return encodings, names, centres
+
+#Function to create query faces, mostly of enrolled people with a few strangers mixed in
+def synthetic_queries(centres, count, seed=1):
+    rng = np.random.default_rng(seed)
+    known = centres[rng.integers(0, len(centres), count)] + rng.normal(0, 0.027, (count, 128)).astype(np.float32)
+    strangers = rng.normal(0, 0.056, (count // 10, 128)).astype(np.float32)
+
+    return np.vstack([known, strangers])
+
+#Function to time matching the queries a few faces at a time (like frames from a clip)
+def time_matching(matcher, queries, faces_per_frame=4):
+    results = []
+    started = time.perf_counter()
+
+    for start in range(0, len(queries), faces_per_frame):
+        results.extend(matcher.match(queries[start:start + faces_per_frame]))
+
+    elapsed = time.perf_counter() - started
+    return results, elapsed * 1000 / len(queries)
+
+#Function to compare exact matching with the ivf index across gallery sizes and nprobe settings
+def bench_index(sizes, nprobes, query_count):
+    report = []
+
+    for size in sizes:
+        encodings, names, centres = synthetic_gallery(size)
+        queries = synthetic_queries(centres, query_count)
+        matcher = face_matcher(encodings, names)
+
+        exact, exact_ms = time_matching(matcher, queries)
+        entry = {"gallery_size": size, "queries": len(queries), "exact_ms_per_face": round(exact_ms, 4), "ivf": []}
+
+        started = time.perf_counter()
+        index = build_ivf_index(matcher.encodings)
+        entry["ivf_build_seconds"] = round(time.perf_counter() - started, 3)
+        entry["ivf_lists"] = len(index.centroids)
+
+        #Recall is how often the index gives the same name as the exact scan
+        matcher.index = index
+        for nprobe in nprobes:
+            index.nprobe = max(1, min(nprobe, len(index.centroids)))
+            approx, approx_ms = time_matching(matcher, queries)
+            recall = sum(1 for (a, b) in zip(exact, approx) if a[0] == b[0]) / len(exact)
+
+            entry["ivf"].append({"nprobe": index.nprobe, "ms_per_face": round(approx_ms, 4), "speedup": round(exact_ms / approx_ms, 2), "recall": round(recall, 4)})
+
+        matcher.index = None
+        report.append(entry)
+
+    return report
+
+#Function to load the face crops we paste into synthetic frames
+def load_faces(face_dir):
+    if not face_dir:
+        raise SystemExit("No face image directory given - pass a directory of face crops with -i")
+
+    faces = []
+    for path in sorted(glob.glob(join(face_dir, "*"))):
+        image = cv2.imread(path)
+        if image is not None:
+            faces.append(image)
+
+    if not faces:
+        raise SystemExit(f"No face images found in {face_dir} - pass a directory of face crops with -i")
+
+    return faces
+
+#Function to build synthetic frames with face crops pasted onto a static background. Returns the frames and the (x, y, w, h) of every pasted face
+def synthetic_frames(faces, width, height, count, faces_per_frame=3, seed=2):
+    rng = np.random.default_rng(seed)
+
+    #Smooth noise makes a background with some texture (like a real scene) that never changes
+    background = cv2.resize(rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    frames, truths = [], []
+
+    for i in range(count):
+        frame = background.copy()
+        boxes = []
+
+        for j in range(faces_per_frame):
+            face = faces[rng.integers(0, len(faces))]
+
+            #Faces between ~6% and ~15% of the frame height, which is typical for a doorway or driveway camera
+            size = int(rng.uniform(0.06, 0.15) * height / 0.6)
+            crop = cv2.resize(face, (size, int(size * face.shape[0] / face.shape[1])))
+            x, y = int(rng.integers(0, width - crop.shape[1])), int(rng.integers(0, height - crop.shape[0]))
+
+            #Skip spots that overlap a face we already placed
+            if any(x < bx + bw and bx < x + crop.shape[1] and y < by + bh and by < y + crop.shape[0] for (bx, by, bw, bh) in boxes):
+                continue
+
+            frame[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+            boxes.append((x, y, crop.shape[1], crop.shape[0]))
+
+        frames.append(frame)
+        truths.append(boxes)
+
+    return frames, truths
+
+#Function to check if a detected box lands on a pasted face (the detected face sits inside the pasted crop)
+def box_hit(box, truth):
+    (x, y, w, h), (tx, ty, tw, th) = box, truth
+    cx, cy = x + w / 2.0, y + h / 2.0
+    return tx <= cx <= tx + tw and ty <= cy <= ty + th and w <= tw * 1.5
+
+#Function to find all four cascade files from the config file, or the copies bundled in FACE FINDER.zip
+def cascade_files(config_file=None):
+    bundled = {"haar_frontal": "frontal_default.xml", "haar_profile": "profile_face.xml", "lbp_frontal": "lbp_frontal_face.xml", "lbp_profile": "lbp_profile_face.xml"}
+    paths = {}
+
+    if config_file:
+        with open(config_file) as file:
+            for row in file.readlines():
+                for key in bundled:
+                    if row.startswith(key + ":"):
+                        paths[key] = row.split(key + ":")[1].replace("\n", "")
+
+    #Anything the config did not give us comes out of the zip
+    missing = [key for key in bundled if key not in paths]
+    if missing:
+        extract_dir = tempfile.mkdtemp(prefix="blue_ss_cascades_")
+        with zipfile.ZipFile(join(project_root, "FACE FINDER.zip")) as bundle:
+            for key in missing:
+                paths[key] = bundle.extract(f"FACE FINDER/Detection Algorythms/{bundled[key]}", extract_dir)
+
+    return paths
+
+#Function to load all four cascades
+def load_cascades(config_file=None):
+    return {key: cv2.CascadeClassifier(path) for (key, path) in cascade_files(config_file).items()}
+
+#Function to measure detection throughput and recall at several detection widths
+def bench_scale(face_dir, width, height, detect_widths, frame_count, config_file=None):
+    cascades = load_cascades(config_file)
+    frontal, profile = cascades["haar_frontal"], cascades["haar_profile"]
+    frames, truths = synthetic_frames(load_faces(face_dir), width, height, frame_count)
+    total_faces = sum(len(boxes) for boxes in truths)
+    report = []
+
+    for detect_width in detect_widths:
+        found, extra = 0, 0
+        started = time.perf_counter()
+
+        for frame, boxes in zip(frames, truths):
+            gray, scale = detection_gray(frame, detect_width)
+            detections = detect_faces(gray, frontal, profile, None, scale)
+
+            found += sum(1 for truth in boxes if any(box_hit(box, truth) for box in detections))
+            extra += sum(1 for box in detections if not any(box_hit(box, truth) for truth in boxes))
+
+        elapsed = time.perf_counter() - started
+        report.append({"detect_width": detect_width or width, "frames_per_sec": round(len(frames) / elapsed, 2), "ms_per_frame": round(elapsed * 1000 / len(frames), 2), "recall": round(found / max(total_faces, 1), 4), "false_positives": extra})
+
+    return {"resolution": f"{width}x{height}", "frames": len(frames), "faces": total_faces, "scales": report}
+
+#Function to time one call and add its total (ms) to the stats under the given stage name
+def timed_stage(stats, stage, function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    stats[stage + "_ms"] = round(stats.get(stage + "_ms", 0.0) + (time.perf_counter() - started) * 1000, 3)
+    return result
+
+#Class for a tiny SMTP stand-in that accepts and throws away mail (EHLO, MAIL, RCPT, DATA, QUIT only)
+class smtp_stand_in(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 blue_ss bench\r\n")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line[:4].upper()
+            if command == b"EHLO" or command == b"HELO":
+                self.wfile.write(b"250-blue_ss bench\r\n250 SIZE 104857600\r\n")
+            elif command == b"DATA":
+                self.wfile.write(b"354 go ahead\r\n")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.wfile.write(b"250 ok\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 ok\r\n")
+
+#Class for the alert aggregator with delivery pointed at the SMTP stand-in (no TLS or login). Collecting, thumbnails and building the message are the real thing
+class bench_alerts(alert_aggregator):
+    def __init__(self, port):
+        super().__init__(0, 480, 6)
+        self.port = port
+
+    def send(self, pending):
+        message = self.build(pending)
+        with smtplib.SMTP("127.0.0.1", self.port) as server:
+            server.send_message(message, "bench@localhost", ["user1@localhost", "user2@localhost"])
+
+#Function to set the BlueSS Facial settings the way parse_config would (with its defaults), but pointed at the bench gallery, cascades and temp directory
+def configure_pipeline(work_dir, paths, gallery_size, threads, smtp_port):
+    settings = {
+        "face_recognition": face_recognition, "alert_email": "bench@localhost", "alert_list": ["user1@localhost", "user2@localhost"],
+        "sample_mode": "nth", "sample_rate": 1, "max_frames": 0, "match_tolerance": 0.6, "index_type": "none", "index_lists": 0, "index_nprobe": 8,
+        "motion_gate_enabled": True, "motion_width": 160, "motion_pixel_threshold": 25, "motion_min_area": 0.002, "motion_learning_rate": 0.1, "camera_settings": {},
+        "detect_width": 0, "track_iou": 0.3, "track_max_gap": 3, "track_best_crops": 3, "person_every": 2, "person_frames": 15,
+        "cache": None, "profile_dir": None, "dlib_file": None, "gallery_dir": join(work_dir, "gallery"), "save_location": join(work_dir, "snapshot_%Y%m%d-%H%M%S%f"),
+        "cascade_files": paths, "detectors": detector_pool(paths, threads), "people": person_detector(640, 0.5), "writer": snapshot_writer("jpg", 90, "full", 0, 32), "alerts": bench_alerts(smtp_port),
+    }
+    for (name, value) in settings.items():
+        setattr(blue_ss_facial, name, value)
+
+    #Save the synthetic gallery and load it the same way the script does
+    encodings, names, centres = synthetic_gallery(gallery_size)
+    save_gallery(settings["gallery_dir"], encodings, names)
+    blue_ss_facial.load_gallery()
+
+#Function to write the synthetic frames out as an mp4 so the decode stage is real
+def write_video(path, frames, fps):
+    height, width = frames[0].shape[:2]
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for frame in frames:
+        video.write(frame)
+    video.release()
+
+#Function to describe the machine and commit the results came from
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_root or ".", capture_output=True, text=True, timeout=5).stdout.strip()
+    except:
+        commit = None
+
+    return {"commit": commit, "machine": platform.machine(), "processor": platform.processor(), "system": platform.platform(), "cores": multiprocessing.cpu_count(), "python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__}
+
+#Function to run a synthetic clip through the real check_faces path (decode, motion gate, detection, tracking, encoding, matching, snapshots and the alert) and report its per stage timings
+def bench_pipeline(face_dir, width, height, seconds, fps, gallery_size, config_file=None, threads=4):
+    work_dir = tempfile.mkdtemp(prefix="blue_ss_bench_")
+
+    try:
+        #Synthetic clip with face crops pasted onto a static background
+        frames, truths = synthetic_frames(load_faces(face_dir), width, height, max(1, int(seconds * fps)))
+        video = join(work_dir, "bench.mp4")
+        write_video(video, frames, fps)
+        person_frames = frames[::max(1, len(frames) // 15)][:15]     #Same number of frames check_faces keeps back for person detection by default
+        del frames
+
+        with socketserver.ThreadingTCPServer(("127.0.0.1", 0), smtp_stand_in) as server:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            configure_pipeline(work_dir, cascade_files(config_file), gallery_size, threads, server.server_address[1])
+
+            started = time.perf_counter()
+            check = blue_ss_facial.check_faces(argparse.Namespace(time=0, file=video))
+            blue_ss_facial.writer.flush()
+            elapsed = time.perf_counter() - started
+            server.shutdown()
+
+        #check_faces only looks for people in clips where no face was tracked (never the case here), so time the person detector on its own
+        people = blue_ss_facial.people
+        person_stats = {}
+        batch = [timed_stage(person_stats, "person_prepare", people.prepare, index, frame) for (index, frame) in enumerate(person_frames)]
+        found = timed_stage(person_stats, "person_detect", people.detect_batch, batch)
+        person_stats.update(people.stats(), people_found=len(found))
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    timings = check.timer.summary()
+    for stage in timings["stages"].values():
+        stage["mean_ms"] = round(stage["total_ms"] / stage["count"], 3)
+    decoded = check.stream.decoded
+
+    return {"environment": environment(), "resolution": f"{width}x{height}", "frames": decoded, "faces_pasted": sum(len(boxes) for boxes in truths), "tracks": len(check.results), "summary": check.summary, "gallery_size": gallery_size, "frames_per_sec": round(decoded / elapsed, 3) if elapsed else 0, "snapshot_writer": blue_ss_facial.writer.stats(), "person_detector": person_stats, "detector_pool": {"threads": threads, "cascades": blue_ss_facial.detectors.stats()}, "total_ms": timings["total_ms"], "stages": timings["stages"]}
+
+### THE THING ###
+if __name__ == '__main__':
+    #Set up and parse through the arguments in order to determine what we need to do
+    parser = argparse.ArgumentParser()
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument("-b", dest="bench", required=True, type=str, choices=["index", "scale", "pipeline"]) #Benchmark to run
+    required_args.add_argument("-s", dest="sizes", required=False, type=str, default="1000,10000,100000") #Gallery sizes for the index benchmark
+    required_args.add_argument("-n", dest="nprobes", required=False, type=str, default="1,2,4,8,16,32") #nprobe settings for the index benchmark
+    required_args.add_argument("-q", dest="queries", required=False, type=int, default=200) #Number of query faces
+    required_args.add_argument("-i", dest="faces", required=False, type=str) #Directory of face crop images to paste into synthetic frames
+    required_args.add_argument("-r", dest="resolution", required=False, type=str, default="1920x1080") #Synthetic frame resolution
+    required_args.add_argument("-w", dest="widths", required=False, type=str, default="0,1280,960,640,480") #Detection widths for the scale benchmark (0 is full resolution)
+    required_args.add_argument("-l", dest="length", required=False, type=int, default=30) #Number of synthetic frames
+    required_args.add_argument("-c", dest="config", required=False, type=str) #blue_ss_facial.conf to take the cascade paths from
+    required_args.add_argument("-t", dest="seconds", required=False, type=float, default=5) #Length of the synthetic clip for the pipeline benchmark (seconds)
+    required_args.add_argument("-f", dest="fps", required=False, type=int, default=15) #Frame rate of the synthetic clip
+    required_args.add_argument("-g", dest="gallery", required=False, type=int, default=5000) #Gallery size for the pipeline benchmark
+    required_args.add_argument("-x", dest="threads", required=False, type=int, default=4) #Detector pool threads for the pipeline benchmark
+    required_args.add_argument("-o", dest="output", required=False, type=str) #File to write the JSON results to as well as printing them
+
+    args = parser.parse_args()
+
+    if args.bench in ("scale", "pipeline") and not args.faces:
+        parser.error(f"-b {args.bench} needs -i <directory of face crop images> to paste into the synthetic frames")
+
+    if args.bench == "index":
+        results = bench_index([int(size) for size in args.sizes.split(",")], [int(nprobe) for nprobe in args.nprobes.split(",")], args.queries)
+
+    if args.bench == "scale":
+        width, height = [int(value) for value in args.resolution.lower().split("x")]
+        results = bench_scale(args.faces, width, height, [int(value) for value in args.widths.split(",")], args.length, args.config)
+
+    if args.bench == "pipeline":
+        width, height = [int(value) for value in args.resolution.lower().split("x")]
+        results = bench_pipeline(args.faces, width, height, args.seconds, args.fps, args.gallery, args.config, args.threads)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)